@@ -0,0 +1,109 @@
+from compression import is_numeric
+
+
+# Windowed aggregation of fast-polled series before they're sent to the server. Instead of every polled value, each
+# window (aligned to wall clock multiples of the window length, so e.g. a 60 second window is on the minute) produces one
+# value for the series itself (the mean of the window's values, or the last value if any of them wasn't numeric), plus
+# optional extra series with other statistics of the window, named by adding a suffix to the series name:
+#
+#   min: <name>_min, max: <name>_max, count: <name>_count, last: <name>_last
+#
+# Summaries are timestamped with the start of their window. Aggregation is configured per device with an aggregation
+# dictionary in the device settings: {"window": 60, "statistics": ["min", "max"]}, and a "series" dictionary can override
+# these per series (or turn aggregation off for a series with false).
+STATISTICS = ('min', 'max', 'count', 'last')
+DEFAULT_STATISTICS = ('min', 'max')
+
+
+# merge aggregation settings for a series; returns None if the series isn't aggregated
+def series_aggregation_settings(device_settings, timeseries_name):
+    if not device_settings:
+        return None
+    settings = {k: v for k, v in device_settings.items() if k != 'series'}
+    series_settings = device_settings.get('series', {}).get(timeseries_name, {})
+    if series_settings is False:
+        return None
+    settings.update(series_settings)
+    if not settings.get('window'):
+        return None
+    return settings
+
+
+# definitions of the extra series produced by aggregating a series with the given settings
+def aggregate_definitions(definition, settings):
+    definitions = []
+    for statistic in settings.get('statistics', DEFAULT_STATISTICS):
+        if statistic in STATISTICS:
+            if statistic == 'count':
+                definitions.append([definition[0], definition[1] + '_count', 'Numeric', 0])
+            else:
+                definitions.append([definition[0], definition[1] + '_' + statistic] + list(definition[2:4]))
+    return definitions
+
+
+# incrementally summarizes one series; only the current window's running statistics are kept
+class WindowAggregator(object):
+
+    def __init__(self, window, statistics=DEFAULT_STATISTICS):
+        self._window = window
+        self._statistics = [statistic for statistic in statistics if statistic in STATISTICS]
+        self._window_start = None
+        self._count = 0
+        self._numeric = True
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+        self._last = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings['window'], settings.get('statistics', DEFAULT_STATISTICS))
+
+    # add a value; if it starts a new window, returns the summary of the previous one (see summary()), otherwise an empty list
+    def add(self, timestamp, value):
+        window_start = timestamp - timestamp % self._window
+        summary = []
+        if window_start != self._window_start:
+            summary = self.summary()
+            self._window_start = window_start
+            self._count = 0
+            self._numeric = True
+            self._sum = 0.0
+        self._count += 1
+        self._last = value
+        if self._numeric and is_numeric(value):
+            value = float(value)
+            self._sum += value
+            if self._count == 1 or value < self._min:
+                self._min = value
+            if self._count == 1 or value > self._max:
+                self._max = value
+        else:
+            self._numeric = False
+        return summary
+
+    # if the current window has ended, returns its summary and starts waiting for the next value
+    def flush(self, now):
+        if self._window_start is None or now < self._window_start + self._window:
+            return []
+        summary = self.summary()
+        self._window_start = None
+        return summary
+
+    # returns a list of (name suffix, timestamp, value) for the current window (or an empty list if there isn't one); the
+    # empty suffix is the series itself
+    def summary(self):
+        if self._window_start is None or not self._count:
+            return []
+        timestamp = self._window_start
+        if not self._numeric:
+            summary = [('', timestamp, self._last)]
+            if 'count' in self._statistics:
+                summary.append(('_count', timestamp, self._count))
+            if 'last' in self._statistics:
+                summary.append(('_last', timestamp, self._last))
+            return summary
+        values = {'min': self._min, 'max': self._max, 'count': self._count, 'last': self._last}
+        summary = [('', timestamp, self._sum / self._count)]
+        summary.extend(('_' + statistic, timestamp, values[statistic]) for statistic in self._statistics)
+        return summary
@@ -0,0 +1,70 @@
+import time
+import sqlite3
+
+
+# Alerts waiting to be sent to the server, kept in SQLite so they survive restarts, along with when each alert label was
+# last sent (used to avoid sending the same alert over and over). Alerts are queued by whoever raises them and sent by a
+# separate greenlet (see DeviceManager.alert_outbox_loop), so a slow or failing server doesn't hold up or break polling,
+# automations or the watchdog.
+class AlertOutbox(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        if path != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS alerts ('
+                           'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'facility_id INTEGER NOT NULL, '
+                           'label TEXT NOT NULL, '
+                           'subject TEXT NOT NULL, '
+                           'body TEXT NOT NULL, '
+                           'queued_at REAL NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS sent_alerts ('
+                           'facility_id INTEGER NOT NULL, '
+                           'label TEXT NOT NULL, '
+                           'sent_at REAL NOT NULL, '
+                           'PRIMARY KEY (facility_id, label))')
+
+    @property
+    def path(self):
+        return self._path
+
+    def add(self, facility_id, label, subject, body):
+        self._conn.execute('INSERT INTO alerts (facility_id, label, subject, body, queued_at) VALUES (?, ?, ?, ?, ?)',
+                           (facility_id, label, subject, body, time.time()))
+
+    # return the queued alerts, oldest first, as (seq, facility id, label, subject, body, queued at) tuples
+    def pending(self):
+        return self._conn.execute('SELECT seq, facility_id, label, subject, body, queued_at FROM alerts ORDER BY seq').fetchall()
+
+    def pending_count(self):
+        return self._conn.execute('SELECT COUNT(*) FROM alerts').fetchone()[0]
+
+    # remove alerts that the server has accepted
+    def remove(self, seqs):
+        with self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('DELETE FROM alerts WHERE seq = ?', [(seq, ) for seq in seqs])
+
+    # the (facility id, label) -> time sent records, for dedupe
+    def sent_alerts(self):
+        return {(facility_id, label): sent_at for facility_id, label, sent_at in self._conn.execute('SELECT facility_id, label, sent_at FROM sent_alerts')}
+
+    def mark_sent(self, facility_id, label, sent_at):
+        self._conn.execute('INSERT OR REPLACE INTO sent_alerts (facility_id, label, sent_at) VALUES (?, ?, ?)', (facility_id, label, sent_at))
+
+    def clear_sent(self, facility_id, label):
+        self._conn.execute('DELETE FROM sent_alerts WHERE facility_id = ? AND label = ?', (facility_id, label))
+
+
+# combine several alerts for one facility into a single subject and body; alerts is a list of (label, subject, body)
+def alert_digest(alerts, max_subject_length=200):
+    if len(alerts) == 1:
+        return alerts[0][1], alerts[0][2]
+    subject = '%d alerts: %s' % (len(alerts), '; '.join(alert[1] for alert in alerts))
+    if len(subject) > max_subject_length:
+        subject = subject[:max_subject_length - 3] + '...'
+    body = '\n\n'.join('%s\n%s' % (alert[1], alert[2]) if alert[2] != alert[1] else alert[1] for alert in alerts)
+    return subject, body
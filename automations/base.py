@@ -3,10 +3,16 @@ from abc import ABC
 
 class TerrawareAutomation(ABC):
 
+    # seconds between runs of an automation with inputs when none of them change, unless its settings give a
+    # fallbackInterval; None to only run when an input changes
+    default_fallback_interval = None
+
     def __init__(self, automation_info):
         self._facility_id = automation_info['facilityId']
         self._name = automation_info['name']
         self._verbosity = automation_info.get('verbosity', 0)
+        settings = automation_info.get('settings') or {}
+        self._fallback_interval = settings.get('fallbackInterval')  # optional; seconds between runs even if inputs don't change
         print('creating automation; facility: %s, name: %s, type: %s' % (self._facility_id, self._name, automation_info['type']))
 
     def name(self):
@@ -14,3 +20,14 @@ class TerrawareAutomation(ABC):
 
     def facility_id(self):
         return self._facility_id
+
+    # the (device id, timeseries name) keys this automation reads; the device manager runs the automation whenever one of
+    # these values changes. Automations that don't declare any inputs are run periodically instead.
+    def inputs(self):
+        return []
+
+    # seconds between runs when no inputs have changed, or None to only run when an input changes
+    def fallback_interval(self):
+        if self._fallback_interval is not None:
+            return self._fallback_interval
+        return self.default_fallback_interval if self.inputs() else 10
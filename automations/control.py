@@ -3,6 +3,8 @@ from .base import TerrawareAutomation
 
 class GeneratorControl(TerrawareAutomation):
 
+    default_fallback_interval = 10  # keep checking in case a relay command is lost while the inputs hold steady
+
     def __init__(self, automation_info):
         super().__init__(automation_info)
         self.monitor_device_id = automation_info['deviceId']
@@ -14,6 +16,9 @@ class GeneratorControl(TerrawareAutomation):
         self.control_timeseries_name = settings['controlTimeseriesName']
         self.test_output_state = settings.get('testOutputState')
 
+    def inputs(self):
+        return [(self.monitor_device_id, self.monitor_timeseries_name), (self.control_device_id, self.control_timeseries_name)]
+
     def run(self, device_manager):
 
         # get state of charge and relay state
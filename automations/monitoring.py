@@ -9,6 +9,9 @@ class EventMonitor(TerrawareAutomation):
         self.monitor_timeseries_name = automation_info['timeseriesName']
         self.prev_state = 0  # want to send alert if start up in alarm state
 
+    def inputs(self):
+        return [(self.monitor_device_id, self.monitor_timeseries_name)]
+
     def run(self, device_manager):
 
         # get alarm state
@@ -30,6 +33,9 @@ class AlarmMonitor(TerrawareAutomation):
         self.monitor_timeseries_name = automation_info['timeseriesName']
         self.prev_state = 0  # want to send alert if start up in alarm state
 
+    def inputs(self):
+        return [(self.monitor_device_id, self.monitor_timeseries_name)]
+
     def run(self, device_manager):
 
         # get alarm state
@@ -53,6 +59,9 @@ class SensorBoundsAlert(TerrawareAutomation):
         self.upper_threshold = automation_info.get('upperThreshold')
         self.prev_value = None
 
+    def inputs(self):
+        return [(self.monitor_device_id, self.monitor_timeseries_name)]
+
     def run(self, device_manager):
 
         # get sensor value
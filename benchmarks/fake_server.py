@@ -0,0 +1,157 @@
+import re
+import sys
+import json
+import time
+import argparse
+import datetime
+
+from gevent import monkey
+monkey.patch_all()
+
+import gevent  # noqa: E402
+from gevent.pywsgi import WSGIServer  # noqa: E402
+
+
+# A local stand-in for terraware-server (and the Keycloak token endpoint) for benchmarking the device manager. It serves
+# device and automation config from a site file like sample-site.json, accepts timeseries definitions, values and alerts,
+# and keeps counts of what it received. The benchmark runner reads the counts from /benchmark/stats and clears them (e.g.
+# after a warm-up period) with a POST to /benchmark/reset.
+#
+# Run on its own with: python benchmarks/fake_server.py --site site.json --port 8080
+
+
+DEVICES_PATH = re.compile(r'^/api/v1/facilities/(\d+)/devices$')
+ALERT_PATH = re.compile(r'^/api/v1/facilities/(\d+)/alert/send$')
+DEVICE_PATH = re.compile(r'^/api/v1/devices/(\d+)$')
+
+
+class FakeServer(object):
+
+    def __init__(self, site_info, latency=0.0, token_lifetime=300):
+        self._devices = site_info.get('devices', [])
+        self._automations = site_info.get('automations', [])
+        self._latency = latency  # seconds to wait before answering each API request
+        self._token_lifetime = token_lifetime
+        self._next_device_id = max([device.get('id', 0) for device in self._devices] + [0]) + 1
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.request_count = 0
+        self.value_count = 0
+        self.series_entry_count = 0
+        self.upload_count = 0
+        self.upload_bytes = 0
+        self.definition_count = 0
+        self.alert_count = 0
+        self.token_count = 0
+        self.value_delays = []  # seconds between each value's timestamp and when we received it
+
+    def stats(self):
+        elapsed = time.time() - self.start_time
+        return {
+            'elapsed_seconds': elapsed,
+            'requests': self.request_count,
+            'uploads': self.upload_count,
+            'upload_bytes': self.upload_bytes,
+            'values': self.value_count,
+            'series_entries': self.series_entry_count,
+            'values_per_second': self.value_count / elapsed if elapsed else 0.0,
+            'definitions': self.definition_count,
+            'alerts': self.alert_count,
+            'tokens': self.token_count,
+            'value_delay_seconds': percentiles(self.value_delays),
+        }
+
+    def app(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ['PATH_INFO']
+        body = environ['wsgi.input'].read()
+        if path.startswith('/benchmark/'):
+            if path == '/benchmark/reset' and method == 'POST':
+                self.reset()
+                return respond(start_response, {'status': 'ok'})
+            if path == '/benchmark/stats':
+                return respond(start_response, self.stats())
+            return respond(start_response, {'status': 'error'}, '404 Not Found')
+
+        self.request_count += 1
+        if self._latency:
+            gevent.sleep(self._latency)
+        if path.endswith('/token') and method == 'POST':
+            self.token_count += 1
+            return respond(start_response, {'token_type': 'Bearer', 'access_token': 'benchmark-%d' % self.token_count, 'expires_in': self._token_lifetime})
+        if method == 'POST' and path == '/api/v1/timeseries/values':
+            return respond(start_response, self.receive_values(body))
+        if method == 'POST' and path == '/api/v1/timeseries/create':
+            self.definition_count += len(json.loads(body)['timeseries'])
+            return respond(start_response, {'status': 'ok'})
+        match = DEVICES_PATH.match(path)
+        if method == 'GET' and match:
+            facility_id = int(match.group(1))
+            return respond(start_response, {'status': 'ok', 'devices': [device for device in self._devices if device.get('facilityId') == facility_id]})
+        if method == 'GET' and path == '/api/v1/automations':
+            facility_id = int(environ.get('QUERY_STRING', '').partition('facilityId=')[2] or 0)
+            return respond(start_response, {'status': 'ok', 'automations': [automation for automation in self._automations if automation.get('facilityId', facility_id) == facility_id]})
+        if method == 'POST' and ALERT_PATH.match(path):
+            self.alert_count += 1
+            return respond(start_response, {'status': 'ok'})
+        if method == 'POST' and path == '/api/v1/devices':
+            self._next_device_id += 1
+            return respond(start_response, {'status': 'ok', 'id': self._next_device_id - 1})
+        if method in ('PUT', 'DELETE') and DEVICE_PATH.match(path):
+            return respond(start_response, {'status': 'ok'})
+        return respond(start_response, {'status': 'error', 'message': 'unknown route'}, '404 Not Found')
+
+    def receive_values(self, body):
+        now = time.time()
+        payload = json.loads(body)
+        timestamps = {}  # parsed timestamps; most values in a request share a handful of them
+        self.upload_count += 1
+        self.upload_bytes += len(body)
+        for entry in payload['timeseries']:
+            self.series_entry_count += 1
+            for value in entry['values']:
+                self.value_count += 1
+                ts = timestamps.get(value['timestamp'])
+                if ts is None:
+                    ts = timestamps[value['timestamp']] = datetime.datetime.fromisoformat(value['timestamp']).timestamp()
+                self.value_delays.append(now - ts)
+        return {'status': 'ok'}
+
+
+def respond(start_response, body, status='200 OK'):
+    data = json.dumps(body).encode()
+    start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(data)))])
+    return [data]
+
+
+# p50/p90/p99/max of a list of numbers (nearest rank)
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None, 'count': 0}
+    values = sorted(values)
+    return {
+        'p50': values[int(0.50 * (len(values) - 1))],
+        'p90': values[int(0.90 * (len(values) - 1))],
+        'p99': values[int(0.99 * (len(values) - 1))],
+        'max': values[-1],
+        'count': len(values),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='local stand-in for terraware-server, for benchmarks')
+    parser.add_argument('--site', required=True, help='site JSON file with devices (and optionally automations) to serve')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before answering each request')
+    args = parser.parse_args()
+    with open(args.site) as site_file:
+        server = FakeServer(json.load(site_file), latency=args.latency)
+    print('fake server listening on port %d' % args.port)
+    sys.stdout.flush()
+    WSGIServer(('127.0.0.1', args.port), server.app, log=None).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
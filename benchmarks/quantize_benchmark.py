@@ -0,0 +1,52 @@
+import os
+import sys
+import random
+import timeit
+import decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from quantize import quantize_values  # noqa: E402
+
+
+# Micro-benchmark comparing the per-value cost of the old polling-loop conversion (a new dict per poll, with every float
+# rounded through decimal.Decimal) against the precision-table fast path. Run with: python benchmarks/quantize_benchmark.py
+
+
+SERIES_COUNT = 50
+ROUNDS = 2000
+
+
+def decimal_conversion(values):
+    decimal_places = 2
+    new_values = {}
+    for k, v in values.items():
+        if isinstance(v, float):
+            v = round(decimal.Decimal(v), decimal_places)
+        new_values[k] = v
+    return new_values
+
+
+def main():
+    random.seed(1)
+    keys = [(1000 + i // 10, 'series_%d' % i) for i in range(SERIES_COUNT)]
+    precision_table = {key: random.choice([0, 1, 2, 3]) for key in keys}
+    polls = [{key: random.uniform(-1000, 1000) for key in keys} for _ in range(100)]
+
+    # check the fast path gives the same numbers as exact decimal rounding
+    for poll in polls:
+        fast = quantize_values(dict(poll), precision_table)
+        for key, value in poll.items():
+            assert decimal.Decimal(str(fast[key])) == round(decimal.Decimal(value), precision_table[key]), (key, value, fast[key])
+
+    value_count = SERIES_COUNT * len(polls) * ROUNDS // 100
+    before = timeit.timeit(lambda: [decimal_conversion(poll) for poll in polls], number=ROUNDS // 100)
+    after = timeit.timeit(lambda: [quantize_values(dict(poll), precision_table) for poll in polls], number=ROUNDS // 100)
+    copy_only = timeit.timeit(lambda: [dict(poll) for poll in polls], number=ROUNDS // 100)  # the benchmark copies inputs so they stay float
+    print('values per run: %d' % value_count)
+    print('Decimal conversion:    %.3f us/value' % (before / value_count * 1e6))
+    print('precision table:       %.3f us/value' % ((after - copy_only) / value_count * 1e6))
+    print('speedup:               %.1fx' % (before / (after - copy_only)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import argparse
+
+
+# Generates a site file for benchmarks by scaling sample-site.json up to a given number of devices, each reporting a given
+# number of series. A fraction of the devices are copies of the sample site's simulated devices (those with local_sim set
+# that aren't hubs or hub children, e.g. the Raspberry Pi, relay and Modbus devices), so their drivers' polling code is
+# exercised too; the rest are mock devices generating seriesCount random walk series. The sim devices report however many
+# series their drivers do, so the total series count is approximately devices * series.
+#
+# Run on its own with: python benchmarks/site_generator.py --devices 100 --series 20 --output site.json
+
+
+SAMPLE_SITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample-site.json')
+FIRST_DEVICE_ID = 100000
+
+
+def generate_site(device_count, series_count, polling_interval=10, facility_id=1, sim_fraction=0.1, sample_site_path=SAMPLE_SITE_PATH):
+    with open(sample_site_path) as sample_file:
+        sample_site = json.load(sample_file)
+    sim_templates = [device for device in sample_site['devices']
+                     if (device.get('settings') or {}).get('local_sim') and 'parentId' not in device and device['type'] != 'hub']
+    sim_count = int(device_count * sim_fraction) if sim_templates else 0
+    devices = []
+    for index in range(device_count):
+        device_id = FIRST_DEVICE_ID + index
+        if index < sim_count:
+            device = json.loads(json.dumps(sim_templates[index % len(sim_templates)]))
+            device['name'] = '%s-%d' % (device['name'], index)
+        else:
+            device = {
+                'name': 'MockSensor-%d' % index,
+                'type': 'sensor',
+                'make': 'Mock',
+                'model': 'Mock',
+                'settings': {'seriesCount': series_count},
+            }
+        device['id'] = device_id
+        device['facilityId'] = facility_id
+        device['pollingInterval'] = polling_interval
+        device.setdefault('settings', {})['pollingInterval'] = polling_interval
+        devices.append(device)
+    return {'devices': devices, 'automations': []}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generate a scaled-up site file for benchmarks')
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--series', type=int, default=20, help='series per mock device')
+    parser.add_argument('--interval', type=float, default=10, help='polling interval in seconds')
+    parser.add_argument('--facility', type=int, default=1)
+    parser.add_argument('--sim-fraction', type=float, default=0.1, help='fraction of devices copied from the sample site\'s simulated devices')
+    parser.add_argument('--output', help='output file (default: standard output)')
+    args = parser.parse_args()
+    site = generate_site(args.devices, args.series, args.interval, args.facility, args.sim_fraction)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(site, output_file, indent=2)
+    else:
+        json.dump(site, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
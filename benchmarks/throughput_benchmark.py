@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import urllib.request
+
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from site_generator import generate_site  # noqa: E402
+
+
+# End-to-end throughput benchmark: runs the device manager (main.py, as in production) against the local server stand-in
+# in benchmarks/fake_server.py, with a generated site of N devices * M series, and measures over a fixed window after a
+# warm-up period:
+#
+#   - values per second received by the server (and the rate the site should produce, for comparison)
+#   - upload request latency percentiles (from the device manager's upload duration histogram, so bucket resolution)
+#   - value delay percentiles: time from a value's timestamp to its arrival at the server
+#   - device manager CPU (percent of one core) and resident memory
+#
+# Results are printed and written as JSON so they can be compared between runs, e.g.:
+#
+#   python benchmarks/throughput_benchmark.py --devices 200 --series 50 --interval 5 --duration 60 --output results.json
+
+
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+UPLOAD_HISTOGRAM = 'device_manager_timeseries_upload_duration_seconds'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def http_json(url, method='GET'):
+    request = urllib.request.Request(url, method=method, data=b'' if method == 'POST' else None)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+# wait for something to listen on a port, giving up early if the process that should be listening exits
+def wait_for_port(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('process exited with code %d before listening on port %d' % (process.returncode, port))
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('nothing listening on port %d after %d seconds' % (port, timeout))
+
+
+# cumulative bucket counts of the upload duration histogram, as a list of (upper bound, count)
+def scrape_upload_histogram(metrics_port):
+    with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % metrics_port, timeout=10) as response:
+        text = response.read().decode()
+    buckets = []
+    for line in text.splitlines():
+        if line.startswith(UPLOAD_HISTOGRAM + '_bucket'):
+            bound = line.split('le="')[1].split('"')[0]
+            buckets.append((float(bound), float(line.rsplit(' ', 1)[1])))
+    return buckets
+
+
+# estimate percentiles from the difference between two scrapes of a cumulative histogram, interpolating within buckets
+def histogram_percentiles(before, after):
+    before_counts = dict(before)
+    buckets = [(bound, count - before_counts.get(bound, 0)) for bound, count in after]
+    total = buckets[-1][1] if buckets else 0
+    result = {'count': int(total)}
+    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        result[name] = None
+        if not total:
+            continue
+        rank = fraction * total
+        lower_bound, lower_count = 0.0, 0
+        for bound, count in buckets:
+            if count >= rank:
+                if bound == float('inf'):
+                    result[name] = lower_bound  # past the last bucket; all we know is that it's at least this
+                else:
+                    result[name] = lower_bound + (bound - lower_bound) * (rank - lower_count) / max(count - lower_count, 1)
+                break
+            lower_bound, lower_count = bound, count
+    return result
+
+
+def run_benchmark(args, work_dir):
+    site = generate_site(args.devices, args.series, args.interval, sim_fraction=args.sim_fraction)
+    site_path = os.path.join(work_dir, 'site.json')
+    with open(site_path, 'w') as site_file:
+        json.dump(site, site_file)
+
+    server_port = free_port()
+    metrics_port = free_port()
+    server_log = open(os.path.join(work_dir, 'fake-server.log'), 'w')
+    manager_log = open(os.path.join(work_dir, 'device-manager.log'), 'w')
+    server_process = subprocess.Popen(
+        [sys.executable, os.path.join(PACKAGE_PATH, 'benchmarks', 'fake_server.py'), '--site', site_path, '--port', str(server_port), '--latency', str(args.latency)],
+        stdout=server_log, stderr=subprocess.STDOUT)
+    manager_process = None
+    try:
+        wait_for_port(server_port, server_process)
+        server_url = 'http://127.0.0.1:%d/' % server_port
+        env = dict(os.environ)
+        env.pop('LOCAL_SIM', None)
+        env.pop('LOCAL_SITE_FILE_OVERRIDE', None)
+        env.update({
+            'SERVER': server_url,
+            'ACCESS_TOKEN_REQUEST_URL': server_url + 'realms/terraware/protocol/openid-connect/token',
+            'KEYCLOAK_API_CLIENT_ID': 'benchmark',
+            'OFFLINE_REFRESH_TOKEN': 'benchmark',
+            'FACILITIES': '1',
+            'SEND_INTERVAL': str(args.send_interval),
+            'SPOOL_FLUSH_INTERVAL': str(min(args.send_interval, 10)),
+            'METRICS_PORT': str(metrics_port),
+            'CONFIG_RELOAD_INTERVAL': '0',
+            'PYTHONUNBUFFERED': '1',
+        })
+        manager_process = subprocess.Popen([sys.executable, os.path.join(PACKAGE_PATH, 'main.py')], cwd=work_dir, env=env,
+                                           stdout=manager_log, stderr=subprocess.STDOUT)
+        process = psutil.Process(manager_process.pid)
+        try:
+            wait_for_port(metrics_port, manager_process, timeout=120)
+        except RuntimeError as ex:
+            raise RuntimeError('device manager did not start (%s); see %s' % (ex, manager_log.name))
+        print('device manager started; warming up for %d seconds' % args.warmup)
+        time.sleep(args.warmup)
+
+        stats_url = server_url + 'benchmark/'
+        http_json(stats_url + 'reset', 'POST')
+        histogram_before = scrape_upload_histogram(metrics_port)
+        cpu_before = process.cpu_times()
+        start_time = time.time()
+        cpu_samples = []
+        rss_samples = []
+        process.cpu_percent()
+        while time.time() - start_time < args.duration:
+            time.sleep(1)
+            if manager_process.poll() is not None:
+                raise RuntimeError('device manager exited with code %d; see %s' % (manager_process.returncode, manager_log.name))
+            cpu_samples.append(process.cpu_percent())
+            rss_samples.append(process.memory_info().rss)
+        elapsed = time.time() - start_time
+        cpu_after = process.cpu_times()
+        server_stats = http_json(stats_url + 'stats')
+        histogram_after = scrape_upload_histogram(metrics_port)
+    finally:
+        if manager_process:
+            manager_process.terminate()
+            manager_process.wait()
+        server_process.terminate()
+        server_process.wait()
+        server_log.close()
+        manager_log.close()
+
+    cpu_seconds = (cpu_after.user + cpu_after.system) - (cpu_before.user + cpu_before.system)
+    series_count = sum(1 for device in site['devices'] if device['make'] == 'Mock') * args.series
+    return {
+        'parameters': {
+            'devices': args.devices,
+            'series_per_device': args.series,
+            'polling_interval': args.interval,
+            'send_interval': args.send_interval,
+            'sim_fraction': args.sim_fraction,
+            'server_latency': args.latency,
+            'warmup_seconds': args.warmup,
+            'duration_seconds': args.duration,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': psutil.cpu_count(),
+        },
+        'mock_series': series_count,
+        'expected_mock_values_per_second': series_count / args.interval,
+        'values_per_second': server_stats['values'] / elapsed,
+        'values': server_stats['values'],
+        'uploads': server_stats['uploads'],
+        'upload_bytes': server_stats['upload_bytes'],
+        'upload_request_seconds': histogram_percentiles(histogram_before, histogram_after),
+        'value_delay_seconds': server_stats['value_delay_seconds'],
+        'cpu_percent': {
+            'mean': 100.0 * cpu_seconds / elapsed,
+            'max': max(cpu_samples) if cpu_samples else None,
+        },
+        'rss_bytes': {
+            'mean': sum(rss_samples) / len(rss_samples) if rss_samples else None,
+            'max': max(rss_samples) if rss_samples else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end device manager throughput benchmark')
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--series', type=int, default=20, help='series per mock device')
+    parser.add_argument('--interval', type=float, default=5, help='device polling interval in seconds')
+    parser.add_argument('--send-interval', type=float, default=10, help='seconds between uploads (SEND_INTERVAL)')
+    parser.add_argument('--sim-fraction', type=float, default=0.1, help='fraction of devices copied from the sample site\'s simulated devices')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake server waits before answering each request')
+    parser.add_argument('--warmup', type=float, default=20, help='seconds to run before measuring')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to measure for')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory (site file, logs, spool)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='device-manager-benchmark-')
+    try:
+        results = run_benchmark(args, work_dir)
+    finally:
+        if args.keep:
+            print('working directory: %s' % work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    upload = results['upload_request_seconds']
+    delay = results['value_delay_seconds']
+    print('%d devices, %d series per mock device, polled every %gs' % (args.devices, args.series, args.interval))
+    print('values/sec: %.1f (mock devices should produce %.1f)' % (results['values_per_second'], results['expected_mock_values_per_second']))
+    print('upload requests: %d, p50: %s, p90: %s, p99: %s' % (upload['count'], format_seconds(upload['p50']), format_seconds(upload['p90']), format_seconds(upload['p99'])))
+    print('value delay p50: %s, p90: %s, p99: %s, max: %s' % (format_seconds(delay['p50']), format_seconds(delay['p90']), format_seconds(delay['p99']), format_seconds(delay['max'])))
+    print('cpu: %.1f%% mean, %.1f%% max; rss: %.1f MB mean, %.1f MB max' % (
+        results['cpu_percent']['mean'], results['cpu_percent']['max'] or 0, (results['rss_bytes']['mean'] or 0) / 1e6, (results['rss_bytes']['max'] or 0) / 1e6))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print('wrote results to %s' % args.output)
+
+
+def format_seconds(seconds):
+    return '-' if seconds is None else '%.3fs' % seconds
+
+
+if __name__ == '__main__':
+    main()
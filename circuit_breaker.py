@@ -0,0 +1,60 @@
+import time
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+# Tracks failures talking to a device. After failure_threshold consecutive failures the breaker opens and the device is
+# left alone for a while; once that time is up the breaker goes half-open and lets a single probe through. A successful
+# probe closes the breaker, and a failed probe opens it again for twice as long (up to max_open_time).
+class CircuitBreaker(object):
+
+    def __init__(self, failure_threshold=5, base_open_time=30.0, max_open_time=3600.0):
+        self._failure_threshold = failure_threshold
+        self._base_open_time = base_open_time
+        self._max_open_time = max_open_time
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.consecutive_opens = 0
+        self.open_until = None  # time.monotonic() value when an open breaker will allow a probe
+        self.failure_count = 0
+        self.trip_count = 0
+
+    # returns true if a request may be made now; moves an open breaker to half-open once its open time is up
+    def allow(self):
+        if self.state == OPEN:
+            if time.monotonic() < self.open_until:
+                return False
+            self.state = HALF_OPEN
+        return True
+
+    # returns true if this closed the breaker
+    def record_success(self):
+        self.consecutive_failures = 0
+        if self.state == CLOSED:
+            return False
+        self.state = CLOSED
+        self.consecutive_opens = 0
+        self.open_until = None
+        return True
+
+    # returns true if this opened the breaker
+    def record_failure(self):
+        self.failure_count += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self._failure_threshold:
+            open_time = min(self._max_open_time, self._base_open_time * (2 ** self.consecutive_opens))
+            self.consecutive_opens += 1
+            self.trip_count += 1
+            self.state = OPEN
+            self.open_until = time.monotonic() + open_time
+            return True
+        return False
+
+    def summary(self):
+        summary = '%s (consecutive failures: %d, total failures: %d, trips: %d)' % (self.state, self.consecutive_failures, self.failure_count, self.trip_count)
+        if self.state == OPEN:
+            summary += ', next probe in %.0fs' % max(0, self.open_until - time.monotonic())
+        return summary
@@ -0,0 +1,117 @@
+import decimal
+import numbers
+
+
+# Per-series compression applied when recording values, so that series that barely move don't send a value on every poll.
+# Settings (all optional; a series with none of them set is recorded on every poll, as before):
+#
+#   deadband: only record a value when it differs from the last recorded value by more than this amount
+#   relativeDeadband: the same, but as a fraction of the last recorded value (e.g. 0.01 for 1%); if both deadbands are
+#       given, a change has to exceed the larger of the two
+#   swingingDoor: compression deviation for swinging door compression of analog values; interior points that lie within
+#       this distance of a straight line between recorded points are dropped. Takes the place of the deadbands.
+#   heartbeat: record a value at least this many seconds after the last recorded value, even if it hasn't changed
+#   sendOnChange: record only values that differ from the last recorded value; implied by any of the settings above
+#
+# Non-numeric values (and bools, which would otherwise count as numbers) are recorded when they change.
+COMPRESSION_SETTINGS = ('deadband', 'relativeDeadband', 'swingingDoor', 'heartbeat', 'sendOnChange')
+
+
+# merge compression settings for a series: device-wide settings, then the device's per-series overrides, then any settings
+# from the timeseries definition; returns None if the series shouldn't be compressed
+def series_compression_settings(device_settings, timeseries_name, definition_settings=None):
+    settings = {}
+    if device_settings:
+        settings.update((k, v) for k, v in device_settings.items() if k in COMPRESSION_SETTINGS)
+        series_settings = device_settings.get('series', {}).get(timeseries_name, {})
+        settings.update((k, v) for k, v in series_settings.items() if k in COMPRESSION_SETTINGS)
+    if definition_settings:
+        settings.update((k, v) for k, v in definition_settings.items() if k in COMPRESSION_SETTINGS)
+    if not any(settings.get(name) for name in COMPRESSION_SETTINGS):
+        return None
+    return settings
+
+
+class SeriesCompressor(object):
+
+    def __init__(self, deadband=0, relative_deadband=0, deviation=0, heartbeat=None):
+        self._deadband = float(deadband or 0)
+        self._relative_deadband = float(relative_deadband or 0)
+        self._deviation = float(deviation or 0)
+        self._heartbeat = float(heartbeat) if heartbeat else None
+        self._recorded_time = None  # time and value of the last recorded point
+        self._recorded_value = None
+        self._pending = None  # swinging door: most recent point seen but not recorded, as (timestamp, value)
+        self._upper_slope = None  # swinging door: slopes of the two sides of the door from the last recorded point
+        self._lower_slope = None
+        self.offered_count = 0
+        self.recorded_count = 0
+
+    # create a compressor from a dictionary of settings as returned by series_compression_settings
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('deadband'), settings.get('relativeDeadband'), settings.get('swingingDoor'), settings.get('heartbeat'))
+
+    # takes a new value and returns a list of (timestamp, value) points to record; swinging door compression may return
+    # an earlier point that turned out to be needed to keep the series within the compression deviation
+    def offer(self, timestamp, value):
+        self.offered_count += 1
+        if self._recorded_time is None:
+            points = self._record(timestamp, value)
+        elif self._heartbeat and timestamp - self._recorded_time >= self._heartbeat:
+            points = self._take_pending() + self._record(timestamp, value)
+        elif not is_numeric(value) or not is_numeric(self._recorded_value):
+            points = self._take_pending() + self._record(timestamp, value) if value != self._recorded_value else []
+        elif self._deviation:
+            points = self._swinging_door(timestamp, value)
+        else:
+            recorded_value = float(self._recorded_value)
+            threshold = max(self._deadband, self._relative_deadband * abs(recorded_value))
+            change = abs(float(value) - recorded_value)
+            points = self._record(timestamp, value) if change > threshold or (not threshold and change) else []
+        self.recorded_count += len(points)
+        return points
+
+    def _record(self, timestamp, value):
+        self._recorded_time = timestamp
+        self._recorded_value = value
+        self._pending = None
+        self._upper_slope = None
+        self._lower_slope = None
+        return [(timestamp, value)]
+
+    # swinging door: the pending point as a list of points to record before recording a point for some other reason
+    # (heartbeat, change of type), since the line from the last recorded point no longer gets extended through it
+    def _take_pending(self):
+        return [self._pending] if self._pending else []
+
+    # Swinging door: the "door" is the range of slopes of lines from the last recorded point that pass within the
+    # deviation of every point seen since. While a new point's slope is inside the door, the line to it would represent all
+    # the points in between, so they can be dropped. Once a point falls outside, the previous point is recorded and a new
+    # door is started from it.
+    def _swinging_door(self, timestamp, value):
+        points = []
+        elapsed = timestamp - self._recorded_time
+        if elapsed <= 0:  # same timestamp as the last recorded point; nothing to draw a line through yet
+            return points
+        slope = (float(value) - float(self._recorded_value)) / elapsed
+        if self._upper_slope is not None and not self._lower_slope <= slope <= self._upper_slope:
+            points = self._record(*self._pending)
+            elapsed = timestamp - self._recorded_time
+            if elapsed <= 0:
+                self._pending = (timestamp, value)
+                return points
+            slope = (float(value) - float(self._recorded_value)) / elapsed
+        upper = slope + self._deviation / elapsed
+        lower = slope - self._deviation / elapsed
+        if self._upper_slope is not None:
+            upper = min(upper, self._upper_slope)
+            lower = max(lower, self._lower_slope)
+        self._upper_slope = upper
+        self._lower_slope = lower
+        self._pending = (timestamp, value)
+        return points
+
+
+def is_numeric(value):
+    return isinstance(value, (numbers.Real, decimal.Decimal)) and not isinstance(value, bool) and value == value
@@ -0,0 +1,53 @@
+import os
+import json
+
+
+# Local copy of the last config we successfully loaded from the server (device lists and automations, per facility), so
+# that after a reboot we can start polling right away instead of waiting for the server, and so that refreshing the config
+# can use conditional requests. Entries are keyed by request URL and hold the response body along with its ETag and
+# Last-Modified headers. The whole cache is a single JSON file that is replaced atomically when it changes.
+class ConfigCache(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    self._entries = json.load(cache_file)
+            except (OSError, ValueError) as ex:
+                print('error reading config cache %s: %s; ignoring it' % (path, ex))
+
+    def get(self, url):
+        return self._entries.get(url)
+
+    # headers for a conditional request for the given URL, so the server can reply 304 Not Modified if nothing changed
+    def conditional_headers(self, url):
+        headers = {}
+        entry = self._entries.get(url)
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    # store a response body; returns true if it differs from what was cached before
+    def put(self, url, body, etag=None, last_modified=None):
+        previous = self._entries.get(url)
+        self._entries[url] = {'body': body, 'etag': etag, 'last_modified': last_modified}
+        self.save()
+        return previous is None or previous['body'] != body
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as cache_file:
+                json.dump(self._entries, cache_file)
+                cache_file.flush()
+                os.fsync(cache_file.fileno())
+            os.replace(temp_path, self.path)
+        except OSError as ex:
+            print('error writing config cache %s: %s' % (self.path, ex))
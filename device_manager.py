@@ -1,6 +1,8 @@
 import gevent
 from gevent import monkey
 monkey.patch_all()
+import gevent.pool
+from gevent.event import AsyncResult, Event
 
 # standard library imports
 import csv
@@ -9,10 +11,8 @@ import json
 import gevent
 import random
 import logging
-import decimal
 
 # For timestamping our timeseries values locally since we batch them up and don't send immediately
-from datetime import timezone
 from datetime import date
 import datetime
 
@@ -20,12 +20,27 @@ from typing import List
 from collections import defaultdict
 
 import os
+import signal
 
 # other imports
-import requests
+import psutil
 from devices.base import TerrawareDevice, TerrawareHub
 from devices.classes import get_device_class
 from automations.classes import get_automation_class
+from timeseries_buffer import TimeseriesBuffer, server_timeseries_entries
+from timeseries_spool import TimeseriesSpool, spool_rows_to_series, chunk_spool_rows
+from server_session import ServerSession
+from config_cache import ConfigCache
+from timeseries_registry import TimeseriesRegistry
+from alert_outbox import AlertOutbox, alert_digest
+from quantize import quantize, quantize_values, DEFAULT_DECIMAL_PLACES
+from compression import SeriesCompressor, series_compression_settings, is_numeric
+from aggregation import WindowAggregator, series_aggregation_settings, aggregate_definitions
+from poll_scheduler import PollScheduler
+from circuit_breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from metrics import MetricsRegistry, COUNT_BUCKETS, SIZE_BUCKETS
+from devices.raspi import RasPiDevice
+from devices.modbus import all_gateways as all_modbus_gateways
 
 
 # manages a set of devices; each device handles a connection to physical hardware
@@ -49,12 +64,41 @@ class DeviceManager(object):
         self.diagnostic_mode = os.environ.get('DIAGNOSTIC_MODE', False)
 
         self.devices = []
+        self.devices_by_id = {}  # device id -> device
+        self.device_infos = {}  # device id -> the config the device was created from (not set for devices created at runtime by hubs)
+        self.default_polling_intervals = {}  # device id -> the driver's polling interval, restored if a reload drops the override
+        self.children_by_parent = defaultdict(list)  # parent (hub) device id -> child devices
         self.automations = []
-        self.timeseries_values_to_send = []
+        self.automation_subscriptions = defaultdict(list)  # (device id, timeseries name) -> automations that use that value
+        self.automation_triggers = {}  # automation -> Event set when one of its inputs changes
+        self.automation_configs = {}  # automation -> the config it was created from, as a string (see config_key)
+        self.automation_greenlets = {}  # automation -> greenlet running automation_loop
+        self.timeseries_buffer = TimeseriesBuffer(  # values waiting to be written to the spool (or sent to the server)
+            max_samples=int(os.environ.get('MAX_VALUES_TO_SEND', 200000)),
+            max_samples_per_series=int(os.environ.get('BUFFER_MAX_VALUES_PER_SERIES', 10000)),
+            max_bytes=int(os.environ.get('BUFFER_MAX_BYTES', 32 * 1024 * 1024)),
+            eviction_policy=os.environ.get('BUFFER_EVICTION_POLICY', 'oldest'))
         self.send_interval = float(os.environ.get('SEND_INTERVAL', 120))  # seconds between sending data to server
         self.last_values = {}  # most recent value for each time series; stored by (device id, series name)
+        self.local_series = set()  # (device id, series name) of series kept in last_values but not sent to the server
+        self.series_precision = {}  # decimal places for each time series, from the timeseries definitions; stored by (device id, series name)
+        self.series_compression = {}  # compression settings given in timeseries definitions; stored by (device id, series name)
+        self.series_compressors = {}  # (device id, series name) -> SeriesCompressor, or None if the series isn't compressed
+        self.series_aggregators = {}  # (device id, series name) -> WindowAggregator, or None if the series isn't aggregated
         self.sent_alerts = {}  # used to keep track of which alerts have already been sent, so as to avoid sending duplicate alerts
         self.last_upload_time = time.time()  # used for watchdog
+        self.device_init_concurrency = int(os.environ.get('DEVICE_INIT_CONCURRENCY', 16))  # max devices constructed at once
+        self.config_reload_interval = float(os.environ.get('CONFIG_RELOAD_INTERVAL', 600))  # seconds between config reloads; 0 to only reload on SIGHUP
+        self.config_reload_requested = Event()
+        self.poll_scheduler = PollScheduler(self.poll_device, self.device_ready_to_poll)
+        self.polling_jitter = float(os.environ.get('POLLING_JITTER', 2))  # default max random offset, in seconds, between device polls
+        self.poll_timeout = float(os.environ.get('POLL_TIMEOUT', 30))  # default seconds to wait for a device poll before giving up
+
+        # a circuit breaker per polled device stops us wasting time on devices that keep failing
+        self.device_breakers = {}  # device id -> CircuitBreaker
+        self.breaker_failure_threshold = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+        self.breaker_base_open_time = float(os.environ.get('BREAKER_BASE_OPEN_TIME', 30))
+        self.breaker_max_open_time = float(os.environ.get('BREAKER_MAX_OPEN_TIME', 3600))
 
         self.local_config_file = os.environ.get('LOCAL_SITE_FILE_OVERRIDE', None)
         self.local_sim = os.environ.get('LOCAL_SIM', False)
@@ -64,20 +108,155 @@ class DeviceManager(object):
         self.api_client_id = os.environ.get('KEYCLOAK_API_CLIENT_ID')
         self.offline_refresh_token = os.environ.get('OFFLINE_REFRESH_TOKEN')
         self.access_token_request_url = os.environ.get('ACCESS_TOKEN_REQUEST_URL')
-        self.max_values_to_send = os.environ.get('MAX_VALUES_TO_SEND', 1000)
+        self.token_renewal_margin = float(os.environ.get('TOKEN_RENEWAL_MARGIN', 60))  # renew access tokens this many seconds before they expire
+        self.auth_header = None
+        self.access_token_lifetime = None  # seconds the current access token was issued for, if the server told us
+        self.access_token_expires_at = None  # time.monotonic() value when the current access token expires
+        self.access_token_refresh = None  # AsyncResult for the token refresh in progress, if any; shared by all callers
+
+        # unsent values are periodically moved from the in-memory buffer to an on-disk spool so they survive outages and restarts
+        self.spool_path = os.environ.get('SPOOL_PATH', 'timeseries-spool.db')  # use ':memory:' to disable persistence
+        self.spool_max_bytes = int(os.environ.get('SPOOL_MAX_BYTES', 100 * 1024 * 1024))
+        self.spool_flush_interval = float(os.environ.get('SPOOL_FLUSH_INTERVAL', 10))  # seconds between writes to the spool
+        self.upload_batch_size = int(os.environ.get('UPLOAD_BATCH_SIZE', 5000))  # max values per request to the server
+        self.upload_batch_bytes = int(os.environ.get('UPLOAD_BATCH_BYTES', 512 * 1024))  # approximate max request body size
+        self.upload_concurrency = int(os.environ.get('UPLOAD_CONCURRENCY', 4))  # max requests in flight while catching up
+
+        # all server requests go through one keep-alive session so we don't pay for a new TCP+TLS handshake on every call
+        self.server_session = ServerSession(
+            connect_timeout=float(os.environ.get('SERVER_CONNECT_TIMEOUT', 10)),
+            read_timeout=float(os.environ.get('SERVER_READ_TIMEOUT', 60)),
+            max_retries=int(os.environ.get('SERVER_MAX_RETRIES', 3)),
+            max_retry_delay=float(os.environ.get('SERVER_MAX_RETRY_DELAY', 120)),
+            pool_size=self.upload_concurrency + 4)  # room for uploads plus alerts and config calls
+
+        self.timeseries_spool = None
+        if not self.local_sim:
+            self.timeseries_spool = TimeseriesSpool(self.spool_path, self.spool_max_bytes)
+            print('timeseries spool %s has %d unsent value(s)' % (self.spool_path, self.timeseries_spool.pending_count()))
+
+        # the last config loaded from the server is kept locally so we can start up while the server is unreachable
+        self.config_cache = ConfigCache(os.environ.get('CONFIG_CACHE_PATH', 'config-cache.json'))
+        self.config_fetches = {}  # url -> greenlet fetching it, so a fetch still retrying in the background is reused
+        self.config_startup_timeout = float(os.environ.get('CONFIG_STARTUP_TIMEOUT', 10))  # seconds to wait for the server before using cached config
+
+        # timeseries definitions the server already has, so we only send new or changed ones
+        self.timeseries_registry = TimeseriesRegistry(os.environ.get('TIMESERIES_REGISTRY_PATH', 'timeseries-registry.json'), self.server_path)
+        self.timeseries_registration_requested = Event()
+        self.definition_batch_size = int(os.environ.get('DEFINITION_BATCH_SIZE', 500))  # max timeseries definitions per request
+
+        # alerts are queued on disk and sent by their own greenlet, so they survive server outages and restarts
+        self.alert_outbox = None
+        self.alert_queued = Event()
+        self.alert_digest_delay = float(os.environ.get('ALERT_DIGEST_DELAY', 10))  # seconds to gather alerts into one message
+        if not self.local_sim:
+            self.alert_outbox = AlertOutbox(os.environ.get('ALERT_OUTBOX_PATH', 'alert-outbox.db'))
+            self.sent_alerts = self.alert_outbox.sent_alerts()
+            pending_alert_count = self.alert_outbox.pending_count()
+            if pending_alert_count:
+                print('alert outbox %s has %d unsent alert(s)' % (self.alert_outbox.path, pending_alert_count))
 
         facilities_string = os.environ.get('FACILITIES', None)
         self.facilities = [int(a) for a in facilities_string.split(',')] if facilities_string else []
 
+        # metrics about the device manager itself, served in Prometheus text format and optionally recorded as timeseries
+        self.metrics_port = int(os.environ.get('METRICS_PORT', 8091))  # 0 disables the metrics endpoint
+        self.metrics_host = os.environ.get('METRICS_HOST', '127.0.0.1')  # interface the metrics endpoint listens on
+        self.metrics_timeseries_interval = float(os.environ.get('METRICS_TIMESERIES_INTERVAL', 0))  # 0 disables recording metrics as timeseries
+        self.metrics = MetricsRegistry()
+        self.create_metrics()
+
         print('*' * 70)
         now_str = datetime.datetime.now().isoformat()
         print ('Device Manager starting at {} with server {} for facilities {}'.format(now_str, self.server_path, self.facilities))
 
-        self.refresh_access_token_from_server()
+        # fetched in the background so that a server outage doesn't stop us from starting up with cached config; requests
+        # made before the token arrives wait for it (see send_request)
+        gevent.spawn(self.refresh_access_token_from_server)
+        if not self.local_sim:
+            gevent.spawn(self.token_renewal_loop)
+            gevent.spawn(self.timeseries_registration_loop)
+            gevent.spawn(self.alert_outbox_loop)
+
+    # define the metrics for the device manager's hot paths; values tracked elsewhere are read when the metrics are scraped
+    def create_metrics(self):
+        m = self.metrics
+        self.device_init_duration_metric = m.histogram('device_init_duration_seconds', 'Time taken to construct each device at startup.', ['device_class'])
+        self.poll_duration_metric = m.histogram('device_poll_duration_seconds', 'Time taken by each device poll.', ['device'])
+        self.poll_values_metric = m.histogram('device_poll_values', 'Number of values returned by each device poll.', ['device'], COUNT_BUCKETS)
+        self.poll_failures_metric = m.counter('device_poll_failures_total', 'Device polls that raised an error or timed out.', ['device', 'reason'])
+        m.gauge('device_poll_lateness_max_seconds', 'Largest delay between when a poll was due and when it started.', ['device'],
+                func=lambda: {(str(device_id), ): stats.max_lateness for device_id, stats in self.poll_scheduler.all_stats().items()})
+        m.counter('device_poll_overruns_total', 'Polls skipped because the previous poll of the device was still running.', ['device'],
+                  func=lambda: {(str(device_id), ): stats.overrun_count for device_id, stats in self.poll_scheduler.all_stats().items()})
+        m.gauge('device_circuit_breaker_state', 'Circuit breaker state per device (0 closed, 1 half-open, 2 open).', ['device'],
+                func=lambda: {(str(device_id), ): BREAKER_STATE_VALUES[breaker.state] for device_id, breaker in self.device_breakers.items()})
+        self.watchdog_reconnects_metric = m.counter('watchdog_reconnects_total', 'Reconnects triggered by the watchdog.', ['device'])
+        m.gauge('modbus_gateway_queue_depth', 'Modbus requests waiting for or using each gateway (shared Modbus TCP connection).', ['gateway'],
+                func=lambda: {(gateway.name, ): gateway.queue_depth for gateway in all_modbus_gateways()})
+        m.counter('modbus_gateway_requests_total', 'Modbus requests sent through each gateway.', ['gateway'],
+                  func=lambda: {(gateway.name, ): gateway.request_count for gateway in all_modbus_gateways()})
+        m.counter('modbus_gateway_request_seconds_total', 'Total time Modbus requests spent on each gateway.', ['gateway'],
+                  func=lambda: {(gateway.name, ): gateway.request_seconds for gateway in all_modbus_gateways()})
+        m.gauge('modbus_gateway_request_max_seconds', 'Longest Modbus request through each gateway.', ['gateway'],
+                func=lambda: {(gateway.name, ): gateway.max_request_seconds for gateway in all_modbus_gateways()})
+        m.counter('modbus_gateway_retries_total', 'Modbus reads through each gateway retried after a failure.', ['gateway'],
+                  func=lambda: {(gateway.name, ): gateway.retry_count for gateway in all_modbus_gateways()})
+        m.counter('modbus_gateway_errors_total', 'Modbus reads through each gateway that failed at the transport level after retrying.', ['gateway'],
+                  func=lambda: {(gateway.name, ): gateway.error_count for gateway in all_modbus_gateways()})
+        m.counter('modbus_rejected_values_total', 'Modbus values discarded for being outside their register\'s sanity bounds, per gateway.', ['gateway'],
+                  func=lambda: {(gateway.name, ): gateway.rejected_value_count for gateway in all_modbus_gateways()})
+        m.counter('modbus_gateway_wait_seconds_total', 'Total time Modbus requests spent waiting for earlier requests to each gateway.', ['gateway'],
+                  func=lambda: {(gateway.name, ): gateway.wait_seconds for gateway in all_modbus_gateways()})
+        self.automation_duration_metric = m.histogram('automation_run_duration_seconds', 'Time taken by each automation run.', ['automation'])
+
+        m.gauge('timeseries_buffer_series', 'Series with values in the in-memory buffer.', func=lambda: len(self.timeseries_buffer))
+        m.gauge('timeseries_buffer_values', 'Values in the in-memory buffer.', func=lambda: self.timeseries_buffer.sample_count)
+        m.gauge('timeseries_buffer_bytes', 'Estimated memory used by values in the in-memory buffer.', func=lambda: self.timeseries_buffer.byte_count)
+        m.counter('timeseries_buffer_evicted_total', 'Values dropped because the in-memory buffer was over its limits.', func=lambda: self.timeseries_buffer.evicted_count)
+        process = psutil.Process()
+        m.gauge('process_resident_memory_bytes', 'Resident memory of the device manager process.', func=lambda: process.memory_info().rss)
+        if self.timeseries_spool:
+            m.gauge('timeseries_spool_values', 'Unsent values in the spool.', func=self.timeseries_spool.pending_count)
+            m.gauge('timeseries_spool_bytes', 'Bytes of live data in the spool.', func=self.timeseries_spool.size_bytes)
+            m.counter('timeseries_spool_evicted_total', 'Values dropped because the spool was over budget.', func=lambda: self.timeseries_spool.evicted_count)
+        self.upload_duration_metric = m.histogram('timeseries_upload_duration_seconds', 'Time taken to upload each chunk of timeseries values.')
+        self.upload_bytes_metric = m.counter('timeseries_upload_bytes_total', 'Bytes of timeseries values sent to the server.')
+        self.upload_values_metric = m.counter('timeseries_upload_values_total', 'Timeseries values sent to the server.')
+        self.upload_size_metric = m.histogram('timeseries_upload_request_bytes', 'Size of each timeseries upload request.', buckets=SIZE_BUCKETS)
+        m.gauge('timeseries_definitions_registered', 'Timeseries definitions the server has accepted.', func=lambda: len(self.timeseries_registry))
+        m.gauge('timeseries_definitions_pending', 'Timeseries definitions waiting to be sent to the server.', func=lambda: self.timeseries_registry.pending_count)
+        self.upload_failures_metric = m.counter('timeseries_upload_failures_total', 'Timeseries upload chunks that failed and were left in the spool.')
+        m.counter('timeseries_compression_offered_total', 'Values received for series with compression enabled.',
+                  func=lambda: sum(c.offered_count for c in self.series_compressors.values() if c))
+        m.counter('timeseries_compression_recorded_total', 'Values recorded for sending after compression.',
+                  func=lambda: sum(c.recorded_count for c in self.series_compressors.values() if c))
+
+        session = self.server_session
+        m.counter('server_requests_total', 'Requests sent to the server.', func=lambda: session.request_stats.count)
+        m.counter('server_request_seconds_total', 'Total time spent on requests to the server.', func=lambda: session.request_stats.total)
+        m.counter('server_connections_total', 'New connections opened to the server.', func=lambda: session.handshake_stats.count)
+        m.counter('server_connection_setup_seconds_total', 'Total time spent opening connections (TCP and TLS) to the server.', func=lambda: session.handshake_stats.total)
+        m.counter('server_retries_total', 'Server requests retried after a connection error, timeout or transient error.', func=lambda: session.retry_count)
+        if self.alert_outbox:
+            m.gauge('alerts_queued', 'Alerts waiting to be sent.', func=self.alert_outbox.pending_count)
+        self.alerts_sent_metric = m.counter('alerts_sent_total', 'Alerts sent to the server (several may be combined into one message).')
+        self.alert_failures_metric = m.counter('alert_send_failures_total', 'Failed attempts to send alerts to the server.')
+        self.unauthorized_metric = m.counter('server_unauthorized_total', 'Server requests rejected because the access token had expired.')
+        self.token_refreshes_metric = m.counter('access_token_refreshes_total', 'Access token requests.')
+        self.config_load_seconds_metric = m.gauge('config_load_seconds', 'Time taken to load each kind of config at startup.', ['kind'])
+
+    # record the unlabeled metrics as timeseries on the Raspberry Pi device (the computer we're running on), if there is one
+    def metrics_timeseries_loop(self, device):
+        names = sorted(self.metrics.scalar_values().keys())
+        self.send_timeseries_definitions_to_server([[device.id, 'device_manager_' + name, 'Numeric', 3] for name in names])
+        while True:
+            gevent.sleep(self.metrics_timeseries_interval)
+            values = self.metrics.scalar_values()
+            self.record_timeseries_values({(device.id, 'device_manager_' + name): value for name, value in values.items()})
 
     # add/initialize devices using a list of dictionaries of device info
     def create_devices(self, device_infos):
-        count_added = 0
         print('device list has information for %d device(s)' % len(device_infos))
 
         # auto-add omnisense hub if needed
@@ -101,44 +280,16 @@ class DeviceManager(object):
                 dev_info['id'] = device_id
                 device_infos.append(dev_info)
 
-        # Create the devices and hubs and save in a flat list
-        for dev_info in device_infos:
-            device = None
-            if dev_info.get('settings', {}).get('enabled', True):
-                device_class = get_device_class(dev_info)
-                if device_class:
-                    device = device_class(dev_info)
-                    if self.local_sim:  # if local sim specified via environment variable, override all devices
-                        device.set_local_sim(self.local_sim)
-                    if 'settings' in dev_info and 'pollingInterval' in dev_info['settings']:  # allow overriding device polling interval
-                        device.set_polling_interval(dev_info['settings']['pollingInterval'])
-                        print('setting polling interval on device %s to %.2f' % (device.name, device.polling_interval))
-                    if hasattr(device, 'set_device_manager'):
-                        print('setting device manager on %s' % device.name)
-                        device.set_device_manager(self)
-                    self.devices.append(device)
-                    count_added += 1
-                else:
-                    print('device not recognized: {}'.format(dev_info))
-            else:
-                print('device disabled (name: %s, type: %s)' % (dev_info['name'], dev_info['type']))
+        new_devices = self.construct_and_add_devices(device_infos)
 
-        # For devices that are children hooked to hubs, find the hubs and link them up.
-        for device in self.devices:
+        # For devices that are children hooked to hubs, find the hubs and link them up. We do this after creating all the
+        # devices since a child may come before its hub in the device list.
+        for device in new_devices:
             if device.parent_id:
-                hub_device = next((x for x in self.devices if x.id == device.parent_id), None)
-                if hub_device:
-                    if hasattr(hub_device, 'add_device'):
-                        if self.diagnostic_mode:
-                            print('Attached device {} to its parent (hub) device {}'.format(device.name, hub_device.name))
-                        hub_device.add_device(device)
-                    else:
-                        print('Error: Device {} has hub id {}, but device with that id is not a hub! (does not inherit from TerrawareHub).'.format(device.name, device.parent_id))
-                else:
-                    print('Error: Device {} has hub id {}, but no device with that id exists! Did you forget to add the hub to the configuration?'.format(device.name, device.parent_id))
+                self.link_device_to_hub(device)
         
         # Let hubs know they all have their child sensors bound up so they can start services or whatever
-        for device in self.devices:
+        for device in new_devices:
             if hasattr(device, 'notify_all_devices_added'):
                 device.notify_all_devices_added()
 
@@ -146,11 +297,56 @@ class DeviceManager(object):
         # the hub object may want to enumerate the timeseries, so we only ask after all the child devices are linked to their hubs,
         # just so the devices can all assume they're fully constructed by the time this gets called.
         timeseries_definitions = []
-        for newdevice in self.devices:
+        for newdevice in new_devices:
             timeseries_definitions.extend(newdevice.get_timeseries_definitions())
-        self.send_timeseries_definitions_to_server(timeseries_definitions)
+        self.send_timeseries_definitions_to_server(timeseries_definitions, wait=False)  # don't hold up polling if the server is down
+
+        return len(new_devices)
+
+    # Create the devices and hubs for a list of device infos (skipping disabled and unrecognized devices) and add them to
+    # our list of devices; returns the new devices. Constructors run concurrently (some of them start services or wait on
+    # external programs), but we add the devices in config order.
+    def construct_and_add_devices(self, device_infos):
+        start_time = time.time()
+        init_pool = gevent.pool.Pool(self.device_init_concurrency)
+        constructions = []
+        for dev_info in device_infos:
+            if dev_info.get('settings', {}).get('enabled', True):
+                device_class = get_device_class(dev_info)
+                if device_class:
+                    constructions.append((dev_info, init_pool.spawn(self.construct_device, device_class, dev_info)))
+                else:
+                    print('device not recognized: {}'.format(dev_info))
+            else:
+                print('device disabled (name: %s, type: %s)' % (dev_info['name'], dev_info['type']))
+        init_pool.join()
+        new_devices = []
+        for dev_info, construction in constructions:
+            device = construction.get()  # re-raises any error from the constructor
+            if self.local_sim:  # if local sim specified via environment variable, override all devices
+                device.set_local_sim(self.local_sim)
+            self.default_polling_intervals[device.id] = device.configured_polling_interval
+            if 'settings' in dev_info and 'pollingInterval' in dev_info['settings']:  # allow overriding device polling interval
+                device.set_polling_interval(dev_info['settings']['pollingInterval'])
+                print('setting polling interval on device %s to %.2f' % (device.name, device.polling_interval))
+            if hasattr(device, 'set_device_manager'):
+                print('setting device manager on %s' % device.name)
+                device.set_device_manager(self)
+            self.add_device(device)
+            self.device_infos[device.id] = dev_info
+            new_devices.append(device)
+        print('constructed %d device(s) in %.2f seconds' % (len(new_devices), time.time() - start_time))
+        return new_devices
 
-        return count_added
+    # construct a device and record how long it took
+    def construct_device(self, device_class, dev_info):
+        start_time = time.time()
+        device = device_class(dev_info)
+        duration = time.time() - start_time
+        self.device_init_duration_metric.observe(duration, (device_class.__name__, ))
+        if self.diagnostic_mode or duration > 1:
+            print('constructing device %s (%s) took %.2f seconds' % (device.name, device_class.__name__, duration))
+        return device
 
     def create_automations(self, automation_infos):
         new_automations = 0
@@ -159,81 +355,300 @@ class DeviceManager(object):
             if automation_class:
                 automation = automation_class(automation_info)
                 self.automations.append(automation)
+                self.automation_configs[automation] = config_key(automation_info)
+                self.automation_triggers[automation] = Event()
+                for key in automation.inputs():
+                    self.automation_subscriptions[key].append(automation)
                 new_automations += 1
             else:
                 print('automation type not found: %s' % automation_info['type'])
         print('created %d automations' % (new_automations))
 
-    # run this function as a greenlet, polling the given device
-    def device_polling_loop(self, device):
+    # run this function as a greenlet; reloads config every CONFIG_RELOAD_INTERVAL seconds, or when we get a SIGHUP
+    def config_reload_loop(self):
         while True:
+            self.config_reload_requested.wait(self.config_reload_interval or None)
+            self.config_reload_requested.clear()
             try:
-                values = device.poll()
+                self.reload_config()
+            except Exception as ex:
+                print('error reloading config: %s' % ex)
+
+    # load the config again and apply any changes to the running devices and automations
+    def reload_config(self):
+        print('reloading config')
+        self.apply_device_config(self.load_device_config())
+        self.apply_automation_config(self.load_automations())
+
+    # Compare a new device list with the running devices and stop, start or reconfigure only the devices that changed.
+    # Devices whose only changes are to settings we can apply in place (polling, compression, aggregation) keep running;
+    # other changed devices are stopped and recreated. Hubs are never recreated, since they own listener sockets and
+    # services; if a hub's config changes in a way we can't apply in place we say so and keep the running hub. Children
+    # added to or removed from a hub are linked or unlinked without touching the hub.
+    def apply_device_config(self, device_infos):
+        new_infos = {}
+        for dev_info in device_infos:
+            if dev_info.get('settings', {}).get('enabled', True) and get_device_class(dev_info):
+                new_infos[dev_info['id']] = dev_info
+
+        stopped_count = 0
+        reconfigured_count = 0
+        infos_to_create = []
+        for device_id, old_info in list(self.device_infos.items()):
+            device = self.devices_by_id[device_id]
+            new_info = new_infos.get(device_id)
+            if new_info is None:
+                if isinstance(device, TerrawareHub):
+                    print('hub %s (id %s) was removed from the config; restart to stop it' % (device.name, device_id))
+                    continue
+                self.stop_device(device)
+                stopped_count += 1
+            elif new_info != old_info:
+                if config_without_keys(new_info, RELOADABLE_SETTINGS) == config_without_keys(old_info, RELOADABLE_SETTINGS):
+                    self.reconfigure_device(device, new_info)
+                    reconfigured_count += 1
+                elif isinstance(device, TerrawareHub):
+                    print('config of hub %s (id %s) changed; restart to apply the changes' % (device.name, device_id))
+                else:
+                    self.stop_device(device)
+                    infos_to_create.append(new_info)
+
+        # devices created at runtime by hubs aren't in device_infos; we adopt their config from the server instead of
+        # creating them again
+        recreated_ids = set(dev_info['id'] for dev_info in infos_to_create)
+        for device_id, new_info in new_infos.items():
+            if device_id not in self.devices_by_id and device_id not in recreated_ids:
+                infos_to_create.append(new_info)
+            elif device_id not in self.device_infos:
+                self.device_infos[device_id] = new_info
+
+        new_devices = self.construct_and_add_devices(infos_to_create)
+        for device in new_devices:
+            if device.parent_id:
+                self.link_device_to_hub(device)
+        for device in new_devices:
+            if isinstance(device, TerrawareHub):
+                for child in self.child_devices(device.id):  # children of a new hub that were already running
+                    if child not in device.devices:
+                        device.add_device(child)
+            if hasattr(device, 'notify_all_devices_added'):
+                device.notify_all_devices_added()
+            self.schedule_device_polling(device)
+        timeseries_definitions = []
+        for device in new_devices:
+            timeseries_definitions.extend(device.get_timeseries_definitions())
+        if timeseries_definitions:
+            self.send_timeseries_definitions_to_server(timeseries_definitions, wait=False)
+        print('config reload: started %d device(s) (%d of them recreated), stopped %d, reconfigured %d' % (
+            len(new_devices), len(recreated_ids), stopped_count, reconfigured_count))
+
+    # apply new settings to a running device without recreating it
+    def reconfigure_device(self, device, dev_info):
+        print('reconfiguring device %s (id %s)' % (device.name, device.id))
+        settings = dev_info.get('settings') or {}
+        device.set_settings(settings)
+        if 'pollingInterval' in settings:
+            device.set_polling_interval(settings['pollingInterval'])
+        elif device.id in self.default_polling_intervals:
+            device.set_polling_interval(self.default_polling_intervals[device.id])
+        # new compression or aggregation settings change the definitions (e.g. adding the aggregate series), so register
+        # them again; the registry only sends ones the server doesn't already have
+        self.send_timeseries_definitions_to_server(device.get_timeseries_definitions(), wait=False)
+        self.device_infos[device.id] = dev_info
+        self.reset_series_state(device.id)
+        self.poll_scheduler.remove(device)
+        self.schedule_device_polling(device)
+
+    # stop polling a device and remove it; values it already recorded are still sent
+    def stop_device(self, device):
+        print('stopping device %s (id %s)' % (device.name, device.id))
+        self.poll_scheduler.remove(device)
+        self.device_breakers.pop(device.id, None)
+        self.default_polling_intervals.pop(device.id, None)
+        self.reset_series_state(device.id)
+        self.remove_device(device)
+        device.shutdown()
+
+    # forget compression and aggregation state for a device's series (after recording any partial aggregation windows) so
+    # that new settings take effect
+    def reset_series_state(self, device_id):
+        for key in [key for key in self.series_aggregators if key[0] == device_id]:
+            aggregator = self.series_aggregators.pop(key)
+            if aggregator:
+                self.record_window_summary(key, aggregator.summary())
+        for key in [key for key in self.series_compressors if key[0] == device_id]:
+            del self.series_compressors[key]
+
+    # compare a new automation list with the running automations; automations whose config is unchanged keep running,
+    # and the rest are stopped or started
+    def apply_automation_config(self, automation_infos):
+        running = {}
+        for automation, key in self.automation_configs.items():
+            running.setdefault(key, []).append(automation)
+        new_infos = []
+        for automation_info in automation_infos:
+            matches = running.get(config_key(automation_info))
+            if matches:
+                matches.pop()
+            else:
+                new_infos.append(automation_info)
+        stopped = [automation for automations in running.values() for automation in automations]
+        for automation in stopped:
+            self.stop_automation(automation)
+        old_automations = set(self.automations)
+        self.create_automations(new_infos)
+        for automation in self.automations:
+            if automation not in old_automations:
+                self.automation_greenlets[automation] = gevent.spawn(self.automation_loop, automation)
+        print('config reload: started %d automation(s), stopped %d' % (len(self.automations) - len(old_automations), len(stopped)))
+
+    def stop_automation(self, automation):
+        greenlet = self.automation_greenlets.pop(automation, None)
+        if greenlet:
+            greenlet.kill()
+        self.automations.remove(automation)
+        del self.automation_configs[automation]
+        del self.automation_triggers[automation]
+        for key in automation.inputs():
+            subscribers = self.automation_subscriptions.get(key)
+            if subscribers and automation in subscribers:
+                subscribers.remove(automation)
+
+    # called by the poll scheduler when a device's poll is due; polls are skipped while the device's circuit breaker is open
+    def device_ready_to_poll(self, device):
+        breaker = self.device_breakers.get(device.id)
+        return breaker.allow() if breaker else True
+
+    # poll the given device once and record its values; called by the poll scheduler in a greenlet per poll
+    def poll_device(self, device):
+        metric_labels = (str(device.id), )
+        start_time = time.monotonic()
+        breaker = self.device_breakers.get(device.id)
+        if breaker and breaker.state == HALF_OPEN:
+            print('probing device {} (id {}) after repeated failures'.format(device.name, device.id))
+            try:
+                device.reconnect()
             except Exception as e:
+                print('error reconnecting to device {} (id {}): {}'.format(device.name, device.id, e))
+
+        timeout = float(device.settings.get('pollTimeout', self.poll_timeout))
+        try:
+            with gevent.Timeout(timeout):
+                values = device.poll()
+            if breaker and breaker.record_success():
+                print('device {} (id {}) is responding again'.format(device.name, device.id))
+        except (Exception, gevent.Timeout) as e:
+            self.poll_failures_metric.inc(labels=(metric_labels[0], 'timeout' if isinstance(e, gevent.Timeout) else 'error'))
+            if isinstance(e, gevent.Timeout):
+                print('timed out after {} seconds polling device {} (id {})'.format(timeout, device.name, device.id))
+            else:
                 print('error polling device {} (id {})'.format(device.name, device.id))
                 print(e)
-                values = {}
+            values = {}
+            if breaker and breaker.record_failure():
+                print('device {} (id {}) has failed {} time(s) in a row; pausing polls: {}'.format(device.name, device.id, breaker.consecutive_failures, breaker.summary()))
+        self.poll_duration_metric.observe(time.monotonic() - start_time, metric_labels)
+        self.poll_values_metric.observe(len(values) if values else 0, metric_labels)
 
-            if values:
-
-                # convert values to Decimal objects
-                # TODO: use decimal places from time series specs
-                decimal_places = 2
-                new_values = {}
-                for k, v in values.items():
-                    if isinstance(v, float):
-                        v = round(decimal.Decimal(v), decimal_places)
-                    new_values[k] = v
-                values = new_values
-
-                # store the values for later sending to server
-                self.record_timeseries_values(values)
-                device.last_update_time = time.time()
-                if self.diagnostic_mode:
-                    print('=== DEVICE POLLING LOOP [{}] - {} values received: ==='.format(device.name, len(values)))
-                    for id_name_pair, value in values.items():
-                        print('    %s: %s' % (id_name_pair, value))
-                    print('======================================================')
+        if values:
 
-            # wait until next round of polling
-            gevent.sleep(device.polling_interval)  # TODO: need to subtract out poll duration
+            # round float values to the decimal places declared in each series' definition
+            quantize_values(values, self.series_precision)
 
-    # run this function as a greenlet, polling the given automation
-    def automation_polling_loop(self, automation):
+            # store the values for later sending to server
+            self.record_timeseries_values(values)
+            device.last_update_time = time.time()
+            if self.diagnostic_mode:
+                print('=== DEVICE POLLING LOOP [{}] - {} values received: ==='.format(device.name, len(values)))
+                for id_name_pair, value in values.items():
+                    print('    %s: %s' % (id_name_pair, value))
+                print('======================================================')
+
+    # run this function as a greenlet; runs the given automation whenever one of its inputs changes (see
+    # record_timeseries_values), and also every fallback interval if the automation has one
+    def automation_loop(self, automation):
+        metric_labels = (automation.name(), )
+        trigger = self.automation_triggers[automation]
+        fallback_interval = automation.fallback_interval()
         while True:
+            trigger.wait(fallback_interval)
+            trigger.clear()
+            start_time = time.monotonic()
             try:
                 automation.run(self)
             except Exception as e:
                 print('error running automation {} (facility: {})'.format(automation.name(), automation.facility_id()))
                 print(e)
                 values = {}
-            gevent.sleep(10)
+            self.automation_duration_metric.observe(time.monotonic() - start_time, metric_labels)
+
+    # add a device to the poll scheduler if it has a polling interval; devices can ask for polls aligned to the wall clock
+    # (settings.pollingAlign) and for their own jitter (settings.pollingJitter, in seconds)
+    def schedule_device_polling(self, device):
+        if device.polling_interval:
+            self.device_breakers[device.id] = CircuitBreaker(self.breaker_failure_threshold, self.breaker_base_open_time, self.breaker_max_open_time)
+            align = device.settings.get('pollingAlign', False)
+            jitter = float(device.settings.get('pollingJitter', self.polling_jitter))
+            self.poll_scheduler.add(device, align=align, jitter=jitter)
 
-    # launch device polling greenlets and run handlers
+    # launch device polling and run handlers
     def run(self):
-        device_polling_greenlet_count = 0
         for device in self.devices:
-            if device.polling_interval:
-                device.greenlet = gevent.spawn(self.device_polling_loop, device)
-                device_polling_greenlet_count += 1
-        print('launched %d greenlet(s) for device and hub polling' % device_polling_greenlet_count)
+            self.schedule_device_polling(device)
+        gevent.spawn(self.poll_scheduler.run)
+        print('scheduled polling for %d device(s) and hub(s)' % len(self.poll_scheduler))
         for automation in self.automations:
-            gevent.spawn(self.automation_polling_loop, automation)
+            self.automation_greenlets[automation] = gevent.spawn(self.automation_loop, automation)
         gevent.spawn(self.watchdog_loop)
+        gevent.spawn(self.config_reload_loop)
+        gevent.signal_handler(signal.SIGHUP, self.config_reload_requested.set)
+        gevent.spawn(self.spool_flush_loop)
+        if self.metrics_port:
+            try:
+                self.metrics.serve(self.metrics_port, self.metrics_host)
+                print('serving metrics on %s port %d' % (self.metrics_host, self.metrics_port))
+            except Exception as ex:  # e.g. the port is in use; carry on without metrics
+                print('unable to serve metrics on %s port %d: %s' % (self.metrics_host, self.metrics_port, ex))
+        if self.metrics_timeseries_interval:
+            raspi_device = next((device for device in self.devices if isinstance(device, RasPiDevice)), None)
+            if raspi_device:
+                gevent.spawn(self.metrics_timeseries_loop, raspi_device)
         while True:
             self.send_timeseries_values_to_server()
             gevent.sleep(self.send_interval)
 
+    def spool_flush_loop(self):
+        while True:
+            gevent.sleep(self.spool_flush_interval)
+            self.flush_timeseries_buffer()
+
+    # move values from the in-memory buffer to the on-disk spool in a single batch
+    def flush_timeseries_buffer(self):
+        self.flush_aggregation_windows()
+        if not self.timeseries_spool or len(self.timeseries_buffer) == 0:
+            return
+        pending_series = self.timeseries_buffer.drain()
+        try:
+            self.timeseries_spool.write(pending_series)
+        except Exception as ex:
+            print('error writing timeseries values to spool %s: %s' % (self.timeseries_spool.path, ex))
+            self.timeseries_buffer.restore(pending_series)  # we'll try again on the next flush
+
     def watchdog_loop(self):
         gevent.sleep(self.send_interval + 30)
         while True:
             for device in self.devices:
                 if not device.expected_update_interval is None:
                     if time.time() - device.last_update_time > device.expected_update_interval:
-                        logging.info('no recent update for device {} (id {}); reconnecting'.format(device.name, device.id))
                         message = 'no recent update for device %s' % device.name
                         self.send_alert(device.facility_id, '%d watchdog' % device.id, message, message)
-                        device.reconnect()
+                        breaker = self.device_breakers.get(device.id)
+                        if breaker and breaker.state != CLOSED:
+                            logging.info('no recent update for device {} (id {}); circuit breaker is {}'.format(device.name, device.id, breaker.state))
+                        else:  # when the breaker isn't closed it reconnects before each probe, so we don't need to here
+                            logging.info('no recent update for device {} (id {}); reconnecting'.format(device.name, device.id))
+                            self.watchdog_reconnects_metric.inc(labels=(str(device.id), ))
+                            device.reconnect()
                     else:
                         self.clear_alert(device.facility_id, '%d watchdog' % device.id)
             if time.time() - self.last_upload_time > self.send_interval * 3 + 30:
@@ -241,14 +656,57 @@ class DeviceManager(object):
                 self.send_alert(self.facilities[0], 'send_to_server', message, message)
             else:
                 self.clear_alert(self.facilities[0], 'send_to_server')
+            if self.diagnostic_mode:
+                for device_id, stats in self.poll_scheduler.all_stats().items():
+                    print('poll timing for device %s: %s' % (device_id, stats.summary()))
+                    print('circuit breaker for device %s: %s' % (device_id, self.device_breakers[device_id].summary()))
             gevent.sleep(30)
 
     def find_device(self, device_id):
-        device = None
-        for d in self.devices:
-            if d.id == device_id:
-                device = d
-        return device
+        return self.devices_by_id.get(device_id)
+
+    # add a device to the list of devices and the indexes; used during startup and when devices are created at runtime
+    # (e.g. when a hub hears from a sensor that isn't in the configuration). Doesn't link the device to its hub; see
+    # link_device_to_hub.
+    def add_device(self, device):
+        self.devices.append(device)
+        self.devices_by_id[device.id] = device
+        self.local_series.update((device.id, name) for name in device.local_timeseries_names())
+        if device.parent_id:
+            self.children_by_parent[device.parent_id].append(device)
+
+    # remove a device from the list of devices, the indexes and its hub
+    def remove_device(self, device):
+        self.devices.remove(device)
+        self.devices_by_id.pop(device.id, None)
+        self.device_infos.pop(device.id, None)
+        self.local_series.difference_update((device.id, name) for name in device.local_timeseries_names())
+        if device.parent_id:
+            siblings = self.children_by_parent.get(device.parent_id)
+            if siblings and device in siblings:
+                siblings.remove(device)
+            hub_device = self.devices_by_id.get(device.parent_id)
+            if hub_device and hasattr(hub_device, 'remove_device'):
+                hub_device.remove_device(device)
+
+    # attach a child device to its hub; returns true on success
+    def link_device_to_hub(self, device):
+        hub_device = self.devices_by_id.get(device.parent_id)
+        if hub_device:
+            if hasattr(hub_device, 'add_device'):
+                if self.diagnostic_mode:
+                    print('Attached device {} to its parent (hub) device {}'.format(device.name, hub_device.name))
+                hub_device.add_device(device)
+                return True
+            else:
+                print('Error: Device {} has hub id {}, but device with that id is not a hub! (does not inherit from TerrawareHub).'.format(device.name, device.parent_id))
+        else:
+            print('Error: Device {} has hub id {}, but no device with that id exists! Did you forget to add the hub to the configuration?'.format(device.name, device.parent_id))
+        return False
+
+    # get the child devices of a hub
+    def child_devices(self, parent_id):
+        return self.children_by_parent.get(parent_id, [])
 
     # get the last value for a particular time series
     def last_value(self, device_id, series_name):
@@ -257,7 +715,8 @@ class DeviceManager(object):
     # APIs for communicating with the terraware-server.
 
     # We use expiring access tokens for server access, and need to periodically request a new one; this is how you do that.
-    # Called immediately on startup and then anytime a query fails
+    # Called immediately on startup, shortly before the current token expires (see token_renewal_loop), and anytime a query
+    # fails with an expired token. If a refresh is already in progress, this waits for it rather than starting another one.
     def refresh_access_token_from_server(self):
         if self.diagnostic_mode:
             print('refresh_access_token_from_server called')
@@ -265,26 +724,60 @@ class DeviceManager(object):
         if self.local_sim:
             return
 
-        request_url = self.access_token_request_url
-        access_token = None
-        parameters = {'client_id': self.api_client_id, 'grant_type': 'refresh_token', 'refresh_token': self.offline_refresh_token}
-        while access_token is None:
-            try:
-                r = requests.post(request_url, data=parameters)
-                r.raise_for_status()
+        if self.access_token_refresh is not None:
+            self.access_token_refresh.get()
+            return
+
+        self.access_token_refresh = AsyncResult()
+        try:
+            request_url = self.access_token_request_url
+            access_token = None
+            parameters = {'client_id': self.api_client_id, 'grant_type': 'refresh_token', 'refresh_token': self.offline_refresh_token}
+            backoff = self.server_session.backoff()
+            while access_token is None:
+                try:
+                    request_time = time.monotonic()
+                    self.token_refreshes_metric.inc()
+                    r = self.server_session.request('POST', request_url, data=parameters)
+                    r.raise_for_status()
+
+                    json = r.json()
+                    access_token = '{} {}'.format(json['token_type'], json['access_token'])
+                    self.auth_header = {"Authorization": access_token}
+
+                    # measure expiry from when we sent the request, so we err on the side of renewing early
+                    if json.get('expires_in'):
+                        self.access_token_lifetime = float(json['expires_in'])
+                        self.access_token_expires_at = request_time + self.access_token_lifetime
+                    else:
+                        self.access_token_lifetime = None
+                        self.access_token_expires_at = None
 
-                # There's other stuff in the response like 'expires_in' for how many seconds this is valid and stuff
-                # But we don't use them right now - could potentially preemptively request new tokens when that time
-                # is nearing to avoid serialized interruptions and maybe save a failed roundtrip or two.
-                json = r.json()
-                access_token = '{} {}'.format(json['token_type'], json['access_token'])
-                self.auth_header = {"Authorization": access_token}
+                    if self.diagnostic_mode:
+                        print('    Success, auth_header is [{}...], expires in {} seconds'.format(abbreviate_string(self.auth_header, 30, 20), self.access_token_lifetime))
+                except Exception as ex:
+                    print('error requesting access token from server {}: {}'.format(request_url, ex))
+                    backoff.sleep()
+        finally:
+            access_token_refresh = self.access_token_refresh
+            self.access_token_refresh = None
+            access_token_refresh.set(None)
 
+    # run this function as a greenlet; renews the access token shortly before it expires so requests don't fail with a 401
+    # first, and so that other greenlets keep using the still-valid old token while the renewal is in progress
+    def token_renewal_loop(self):
+        while True:
+            if self.access_token_expires_at is None:  # server didn't tell us when the token expires; rely on 401 handling
+                gevent.sleep(60)
+                continue
+            margin = min(self.token_renewal_margin, self.access_token_lifetime / 2)
+            time_until_renewal = self.access_token_expires_at - margin - time.monotonic()
+            if time_until_renewal > 0:
+                gevent.sleep(time_until_renewal)
+            else:
                 if self.diagnostic_mode:
-                    print('    Success, auth_header is [{}...]'.format(abbreviate_string(self.auth_header, 30, 20)))
-            except Exception as ex:
-                print('error requesting access token from server {}: {}'.format(request_url, ex))
-                gevent.sleep(120)
+                    print('access token expires in %.0f seconds; renewing' % (self.access_token_expires_at - time.monotonic()))
+                self.refresh_access_token_from_server()
 
     def load_device_config(self):
         if self.diagnostic_mode:
@@ -295,20 +788,10 @@ class DeviceManager(object):
             with open(self.local_config_file) as json_file:
                 site_info = json.loads(json_file.read())
                 device_infos = site_info['devices']
-        else:  # load devices from the server
-            server_name = self.server_path
-            url = server_name + 'api/v1/facilities/{}/devices'
-            for facility_id in self.facilities:
-                received_facility_devices = False
-                while not received_facility_devices:
-                    try:
-                        r = self.send_request(requests.get, url.format(facility_id))
-                        r.raise_for_status()
-                        device_infos += r.json()['devices']
-                        received_facility_devices = True
-                    except Exception as ex:
-                        print('error requesting devices from server %s: %s' % (server_name, ex))
-                        gevent.sleep(120)
+        else:  # load devices from the server (or the config cache)
+            url = self.server_path + 'api/v1/facilities/{}/devices'
+            for facility_id, body in self.load_facility_config('devices', url).items():
+                device_infos += body['devices']
         print('loaded %d devices from %s' % (len(device_infos), self.local_config_file if self.local_config_file else self.server_path))
         return device_infos
 
@@ -321,29 +804,66 @@ class DeviceManager(object):
                 site_info = json.loads(json_file.read())
                 all_automation_infos = site_info['automations']
         else:
-            for facility_id in self.facilities:
-                received_facility_automations = False
-                while not received_facility_automations:
-                    try:
-                        url = self.server_path + 'api/v1/automations?facilityId=%s' % facility_id
-                        r = self.send_request(requests.get, url)
-                        r.raise_for_status()
-                        automation_infos = r.json()['automations']
-                        for automation_info in automation_infos:
-                            automation_info['facilityId'] = facility_id
-                        all_automation_infos += automation_infos
-                        received_facility_automations = True
-                    except Exception as ex:
-                        print('error requesting automations from server %s: %s' % (self.server_path, ex))
-                        gevent.sleep(120)
+            url = self.server_path + 'api/v1/automations?facilityId={}'
+            for facility_id, body in self.load_facility_config('automations', url).items():
+                all_automation_infos += [dict(automation_info, facilityId=facility_id) for automation_info in body['automations']]
         return all_automation_infos
 
+    # Get a piece of config (the response body of url_template formatted with each facility id) for all our facilities,
+    # returned as a dictionary of facility id -> body. The facilities are requested concurrently. Any facility that the
+    # server hasn't answered for within CONFIG_STARTUP_TIMEOUT seconds is loaded from the config cache instead if possible,
+    # so that we can start polling during a server outage; its request keeps retrying in the background and updates the
+    # cache when it succeeds (the new config is picked up the next time config is loaded); later loads wait on that same
+    # request rather than starting another. Without a cached copy we wait for the server as before.
+    def load_facility_config(self, kind, url_template):
+        start_time = time.time()
+        fetches = {}
+        new_fetches = set()
+        for facility_id in self.facilities:
+            url = url_template.format(facility_id)
+            fetch = self.config_fetches.get(url)
+            if fetch is None or fetch.ready():
+                fetch = self.config_fetches[url] = gevent.spawn(self.fetch_config, url)
+                new_fetches.add(facility_id)
+            fetches[facility_id] = fetch
+        gevent.joinall(list(fetches.values()), timeout=self.config_startup_timeout)
+        bodies = {}
+        for facility_id, fetch in fetches.items():
+            url = url_template.format(facility_id)
+            cached = self.config_cache.get(url)
+            if not fetch.ready() and cached:
+                print('server has not responded with %s for facility %s; using cached copy' % (kind, facility_id))
+                if facility_id in new_fetches:
+                    fetch.link_value(lambda fetch, facility_id=facility_id: print('refreshed cached %s for facility %s' % (kind, facility_id)))
+                bodies[facility_id] = cached['body']
+            else:
+                bodies[facility_id] = fetch.get()
+        self.config_load_seconds_metric.set(time.time() - start_time, labels=(kind, ))
+        return bodies
+
+    # get a piece of config from the server, retrying until we get it; uses a conditional request if we have a cached copy
+    # and stores the result in the cache
+    def fetch_config(self, url):
+        backoff = self.server_session.backoff()
+        while True:
+            try:
+                r = self.send_request('GET', url, headers=self.config_cache.conditional_headers(url))
+                if r.status_code == 304:
+                    return self.config_cache.get(url)['body']
+                r.raise_for_status()
+                body = r.json()
+                self.config_cache.put(url, body, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+                return body
+            except Exception as ex:
+                print('error requesting %s from server: %s' % (url, ex))
+                backoff.sleep()
+
     def send_device_definition_to_server(self, device_info):
         assert not 'id' in device_info
         url = self.server_path + 'api/v1/devices'
         print('creating device with type %s' % device_info['type'])
         print(device_info)
-        r = self.send_request(requests.post, url, device_info)
+        r = self.send_request('POST', url, device_info)
         r.raise_for_status()
         return r.json()['id']  # return ID assigned by server
 
@@ -353,16 +873,28 @@ class DeviceManager(object):
         del upload_device_info['id']  # ID goes in URL, not payload
         print('updating device info for device %d' % device_info['id'])
         print(upload_device_info)
-        r = self.send_request(requests.put, url, upload_device_info)
+        r = self.send_request('PUT', url, upload_device_info)
         r.raise_for_status()
 
     # NOTE: this isn't implemented on the back end, but would be useful to have at some point
     def delete_device_definition_on_server(self, device_id):
         print('device device info for device %s' % device_id)
-        r = self.send_request(requests.delete, self.server_path + 'api/v1/devices/%s' % device_id, {})
+        r = self.send_request('DELETE', self.server_path + 'api/v1/devices/%s' % device_id, {})
         r.raise_for_status()
 
-    def send_timeseries_definitions_to_server(self, timeseries_definitions):
+    # records the definitions locally (precision, compression) and sends them to the server, retrying until the server accepts
+    # them; if wait is false, the sending happens in a separate greenlet
+    def send_timeseries_definitions_to_server(self, timeseries_definitions, wait=True):
+        timeseries_definitions = timeseries_definitions + self.aggregate_timeseries_definitions(timeseries_definitions)
+        for definition in timeseries_definitions:
+            key = (definition[0], definition[1])
+            self.series_precision[key] = int(definition[3])
+            if len(definition) > 4 and definition[4]:
+                self.series_compression[key] = definition[4]
+            else:
+                self.series_compression.pop(key, None)
+            self.series_compressors.pop(key, None)  # pick up any new settings next time we record a value
+
         if self.diagnostic_mode:
             print('=== SEND TIMESERIES DEFINITIONS TO SERVER - values received: ===')
             for a in timeseries_definitions:
@@ -372,99 +904,253 @@ class DeviceManager(object):
         if self.local_sim:
             return
 
-        server_name = self.server_path
-        url = server_name + 'api/v1/timeseries/create'
-
+        # The incoming format of timseries_definitions is just a list of lists, where each contained list is four elements:
+        # [device id, timeseries name, data type, decimal places], optionally followed by a dictionary of compression settings
+        # (which stay on our side). Only definitions the server doesn't already have are sent.
         create_timeseries_entries = [{
             'deviceId': definition[0],
             'timeseriesName': definition[1],
             'type': definition[2].capitalize(),
             'decimalPlaces': definition[3],
         } for definition in timeseries_definitions]
+        if not self.timeseries_registry.queue(create_timeseries_entries):
+            return
+        if wait:
+            self.register_pending_timeseries(retry=True)
+        else:
+            self.timeseries_registration_requested.set()
 
-        payload = {'timeseries': create_timeseries_entries}
+    # define series we haven't seen a definition for, so that series that appear at runtime (e.g. a new disk on the
+    # Raspberry Pi) can be stored by the server; values is a dictionary of (device id, timeseries name) -> value
+    def define_unseen_timeseries(self, values):
+        timeseries_definitions = []
+        for key, value in values.items():
+            data_type = 'Numeric' if is_numeric(value) else 'Text'
+            timeseries_definitions.append([key[0], key[1], data_type, DEFAULT_DECIMAL_PLACES])
+            if self.diagnostic_mode:
+                print('defining new timeseries %s as %s' % (key, data_type))
+        self.send_timeseries_definitions_to_server(timeseries_definitions, wait=False)
 
-        # The incoming format of timseries_definitions is just a list of lists, where each contained list is four elements:
-        # [device id, timeseries name, data type, decimal places].
-        success = False
-        while not success:
-            try:
-                r = self.send_request(requests.post, url, payload)
-                r.raise_for_status()
-                success = True
-            except Exception as ex:
-                print('error sending timeseries definitions to server %s: %s' % (server_name, ex))
-                print('---- payload ----')
-                print(payload)  # some debug printing
-                print('---- end payload ----')
-                gevent.sleep(120)
+    # run this function as a greenlet; sends queued timeseries definitions to the server in batches, shortly after they're
+    # queued (so definitions queued together go in one request), retrying with backoff until they're all sent
+    def timeseries_registration_loop(self):
+        backoff = self.server_session.backoff()
+        while True:
+            self.timeseries_registration_requested.wait()
+            gevent.sleep(1)  # gather definitions queued around the same time
+            self.timeseries_registration_requested.clear()
+            if self.register_pending_timeseries():
+                backoff.reset()
+            else:
+                backoff.sleep()
+                self.timeseries_registration_requested.set()
+
+    # send queued timeseries definitions to the server in batches; returns true if the queue was emptied. If retry is set,
+    # keeps retrying until it is.
+    def register_pending_timeseries(self, retry=False):
+        backoff = self.server_session.backoff()
+        while self.timeseries_registry.pending_count:
+            if self.post_timeseries_definitions(self.timeseries_registry.pending(self.definition_batch_size)):
+                backoff.reset()
+            elif retry:
+                backoff.sleep()
+            else:
+                return False
+        return True
+
+    # send a batch of timeseries definition entries to the server; returns false if the batch should be retried later. If
+    # the server rejects the batch as invalid, we split it to find the entries it doesn't like, so one bad definition
+    # doesn't stop the others from being registered.
+    def post_timeseries_definitions(self, entries):
+        url = self.server_path + 'api/v1/timeseries/create'
+        try:
+            r = self.send_request('POST', url, {'timeseries': entries})
+        except Exception as ex:
+            print('error sending %d timeseries definition(s) to server %s: %s' % (len(entries), self.server_path, ex))
+            return False
+        if r.ok:
+            self.timeseries_registry.mark_registered(entries)
+            return True
+        if 400 <= r.status_code < 500 and r.status_code != 429:
+            if len(entries) == 1:
+                print('server rejected timeseries definition %s (status %d): %s' % (entries[0], r.status_code, r.text))
+                self.timeseries_registry.reject(entries)
+                return True
+            middle = len(entries) // 2
+            first_sent = self.post_timeseries_definitions(entries[:middle])
+            return self.post_timeseries_definitions(entries[middle:]) and first_sent
+        print('error sending %d timeseries definition(s) to server %s: status %d' % (len(entries), self.server_path, r.status_code))
+        return False
 
     # values is a dictionary that maps from the tuple (device id, timeseries name) -> value
     def record_timeseries_values(self, values):
+
+        # wake up any automations whose inputs changed, and look for series we don't have a definition for
+        subscriptions = self.automation_subscriptions
+        series_precision = self.series_precision
+        local_series = self.local_series
+        unseen_values = None
+        local_keys = None
+        for key, value in values.items():
+            automations = subscriptions.get(key)
+            if automations and self.last_values.get(key) != value:
+                for automation in automations:
+                    self.automation_triggers[automation].set()
+            if key in local_series:
+                if local_keys is None:
+                    local_keys = []
+                local_keys.append(key)
+            elif key not in series_precision:
+                if unseen_values is None:
+                    unseen_values = {}
+                unseen_values[key] = value
+        if unseen_values:
+            self.define_unseen_timeseries(unseen_values)
+
         self.last_values.update(values)
 
         if self.local_sim:
             return
+        if local_keys:  # kept for automations only
+            values = {key: value for key, value in values.items() if key not in local_series}
 
         ts = int(time.time())  # UTC timestamp
-        timestamp = datetime.datetime.fromtimestamp(ts, timezone.utc).isoformat()
-
-        # The server-side API takes a dictionary 
-        for key_tuple, scalar_value in values.items():
-            found = False
-            for entry in self.timeseries_values_to_send:
-                if entry['deviceId'] == key_tuple[0] and entry['timeseriesName'] == key_tuple[1]:
-                    entry['values'].append({
-                        'timestamp': timestamp,
-                        'value': str(scalar_value)
-                    })
-                    found = True
-            if not found:
-                self.timeseries_values_to_send.append({
-                    'deviceId': key_tuple[0],
-                    'timeseriesName': key_tuple[1],
-                    'values': [{
-                        'timestamp': timestamp,
-                        'value': str(scalar_value)
-                    }]
-                })
-
-        # limit total number of time series value stored/sent
-        if len(self.timeseries_values_to_send) > self.max_values_to_send:
-            self.timeseries_values_to_send = self.timeseries_values_to_send[-self.max_values_to_send:]
+        aggregators = self.series_aggregators
+        compressors = self.series_compressors
+        uncompressed_values = {}
+        for key, value in values.items():
+            if key not in aggregators:
+                aggregators[key] = self.create_series_aggregator(key)
+            aggregator = aggregators[key]
+            if aggregator is not None:
+                self.record_window_summary(key, aggregator.add(ts, value))
+                continue
+            if key not in compressors:
+                compressors[key] = self.create_series_compressor(key)
+            compressor = compressors[key]
+            if compressor is None:
+                uncompressed_values[key] = value
+            else:
+                for point_ts, point_value in compressor.offer(ts, value):
+                    self.timeseries_buffer.append_point(key, point_ts, point_value)
+        self.timeseries_buffer.append(uncompressed_values, ts)  # the buffer enforces its own size limits
+
+    # add the summary of an aggregation window (see aggregation.py) to the buffer, via compression if the summary series
+    # are compressed
+    def record_window_summary(self, key, summary):
+        device_id, timeseries_name = key
+        for suffix, window_ts, value in summary:
+            summary_key = (device_id, timeseries_name + suffix) if suffix else key
+            value = quantize(value, self.series_precision.get(summary_key, DEFAULT_DECIMAL_PLACES))
+            if summary_key not in self.series_compressors:
+                self.series_compressors[summary_key] = self.create_series_compressor(summary_key)
+            compressor = self.series_compressors[summary_key]
+            points = compressor.offer(window_ts, value) if compressor else [(window_ts, value)]
+            for point_ts, point_value in points:
+                self.timeseries_buffer.append_point(summary_key, point_ts, point_value)
+
+    # record the summaries of any aggregation windows that have ended, so series that stop receiving values (or are polled
+    # less often than their window) don't hold back their last window indefinitely
+    def flush_aggregation_windows(self):
+        now = time.time()
+        for key, aggregator in self.series_aggregators.items():
+            if aggregator is not None:
+                self.record_window_summary(key, aggregator.flush(now))
+
+    # definitions for the extra series (min, max, etc.) produced by aggregating series of devices that use aggregation
+    def aggregate_timeseries_definitions(self, timeseries_definitions):
+        definitions = []
+        for definition in timeseries_definitions:
+            device = self.devices_by_id.get(definition[0])
+            settings = series_aggregation_settings(device.settings.get('aggregation'), definition[1]) if device else None
+            if settings:
+                definitions.extend(aggregate_definitions(definition, settings))
+        return definitions
 
+    # create an aggregator for a series using the device's aggregation settings; returns None if the series isn't aggregated
+    def create_series_aggregator(self, key):
+        device = self.devices_by_id.get(key[0])
+        settings = series_aggregation_settings(device.settings.get('aggregation'), key[1]) if device else None
+        return WindowAggregator.from_settings(settings) if settings else None
+
+    # create a compressor for a series using settings from the device's compression settings and the timeseries definition
+    # (see compression.py); returns None if the series isn't compressed
+    def create_series_compressor(self, key):
+        device = self.devices_by_id.get(key[0])
+        device_settings = device.settings.get('compression') if device else None
+        settings = series_compression_settings(device_settings, key[1], self.series_compression.get(key))
+        return SeriesCompressor.from_settings(settings) if settings else None
+
+    # send everything in the spool to the server, oldest values first. The backlog is split into size-bounded chunks which
+    # are uploaded by a bounded number of concurrent greenlets; each chunk is removed from the spool once the server accepts
+    # it, so after a failure only the chunks that didn't make it are sent again next time.
     def send_timeseries_values_to_server(self):
         if self.local_sim:
             return
-        server_name = self.server_path
-        url = server_name + 'api/v1/timeseries/values'
-        if len(self.timeseries_values_to_send) > 0:
-            values_to_send = self.timeseries_values_to_send.copy()
-            self.timeseries_values_to_send = []  # assuming this is atomic with line above
-            payload = {
-                'timeseries': values_to_send
-            }
-            if self.diagnostic_mode:
-                print('Sending {} timeseries values to server'.format(len(payload)))
-            try:
-                r = self.send_request(requests.post, url, payload)
-                r.raise_for_status()
-                response = r.json()
-            except Exception as ex:
-                print('error sending timeseries values to server %s: %s' % (server_name, ex))
-                self.timeseries_values_to_send += values_to_send  # we'll try again later
-                return
-            if response['status'] == 'error':
-                failures = response['failures']
-                print('failed updates:')
-                for failed_update in failures:
-                    print('    device: %d, time series: %s' % (failed_update['deviceId'], failed_update['timeseriesName']))
-                fail_count = len(failures)
-            else:
-                self.last_upload_time = time.time()  # record successful upload for watchdog; we assume that there is some data to upload each time this is called
-                fail_count = 0
+        self.flush_timeseries_buffer()
+        if self.timeseries_registry.pending_count:  # make sure the server knows about the series before sending their values
+            self.register_pending_timeseries()
+        url = self.server_path + 'api/v1/timeseries/values'
+        start_time = time.time()
+        upload_pool = gevent.pool.Pool(self.upload_concurrency)
+        upload_results = []
+        after_seq = 0
+        while not any(result[0] is False for result in upload_results):  # stop queueing new chunks once one has failed
+            rows = self.timeseries_spool.read(self.upload_batch_size * self.upload_concurrency, after_seq)
+            if not rows:
+                break
+            after_seq = rows[-1][0]
+            for chunk in chunk_spool_rows(rows, self.upload_batch_size, self.upload_batch_bytes):
+                upload_pool.spawn(self.send_timeseries_chunk, url, chunk, upload_results)  # blocks while the pool is full
+        upload_pool.join()
+        if not upload_results:  # nothing to send (e.g. compressed series holding steady); that's not an upload failure
+            self.last_upload_time = time.time()
+        sent_count = sum(result[1] for result in upload_results if result[0])
+        value_count = sum(result[2] for result in upload_results if result[0])
+        fail_count = sum(result[3] for result in upload_results if result[0])
+        failed_chunk_count = sum(1 for result in upload_results if not result[0])
+        if sent_count or fail_count or failed_chunk_count:
             now_str = datetime.datetime.now().strftime('%H:%M:%S')
-            print('%s: sent %d updates; had %d failures' % (now_str, len(values_to_send), fail_count))
+            elapsed = time.time() - start_time
+            print('%s: sent %d updates (%d values in %d chunks, %.1f values/sec); had %d failures; %d chunk(s) left for retry' % (
+                now_str, sent_count, value_count, len(upload_results) - failed_chunk_count, value_count / max(elapsed, 0.001), fail_count, failed_chunk_count))
+            if self.diagnostic_mode:
+                print('server session stats: %s' % self.server_session.summary())
+
+    # upload one chunk of spool rows; appends (success, series count, value count, rejected series count) to results
+    def send_timeseries_chunk(self, url, rows, results):
+        values_to_send = server_timeseries_entries(spool_rows_to_series(rows))
+        payload = {
+            'timeseries': values_to_send
+        }
+        if self.diagnostic_mode:
+            print('Sending {} timeseries values to server'.format(len(rows)))
+        start_time = time.monotonic()
+        try:
+            r = self.send_request('POST', url, payload)
+            r.raise_for_status()
+            response = r.json()
+        except Exception as ex:
+            print('error sending timeseries values to server %s: %s' % (self.server_path, ex))
+            self.upload_failures_metric.inc()
+            results.append((False, 0, 0, 0))  # values stay in the spool; we'll try again later
+            return
+        request_bytes = len(r.request.body or b'')
+        self.upload_duration_metric.observe(time.monotonic() - start_time)
+        self.upload_size_metric.observe(request_bytes)
+        self.upload_bytes_metric.inc(request_bytes)
+        self.upload_values_metric.inc(len(rows))
+        fail_count = 0
+        if response['status'] == 'error':
+            failures = response['failures']
+            print('failed updates:')
+            for failed_update in failures:
+                print('    device: %d, time series: %s' % (failed_update['deviceId'], failed_update['timeseriesName']))
+            fail_count = len(failures)
+        else:
+            self.last_upload_time = time.time()  # record successful upload for watchdog
+        self.timeseries_spool.ack(rows[0][0], rows[-1][0])  # the server has seen these values; retrying rejected ones won't help
+        results.append((True, len(values_to_send), len(rows), fail_count))
 
     def create_automation_on_server(self, automation_info):
         assert automation_info['facilityId'] in self.facilities
@@ -472,7 +1158,7 @@ class DeviceManager(object):
         url = self.server_path + 'api/v1/automations'
         print('creating automation %s with type %s' % (automation_info['name'], automation_info['type']))
         print(automation_info)
-        r = self.send_request(requests.post, url, automation_info)
+        r = self.send_request('POST', url, automation_info)
         r.raise_for_status()
         return r.json()['id']  # return ID assigned by server
 
@@ -483,9 +1169,11 @@ class DeviceManager(object):
         del upload_automation_info['id']  # ID goes in URL, not payload
         print('updating automation %d' % automation_info['id'])
         print(upload_automation_info)
-        r = self.send_request(requests.put, url, upload_automation_info)
+        r = self.send_request('PUT', url, upload_automation_info)
         r.raise_for_status()
 
+    # Queue an alert to be sent to the facility's users. Alerts with avoid_resend set aren't sent again for 24 hours (or
+    # until cleared with clear_alert). The alert is sent by alert_outbox_loop, so this doesn't wait for the server.
     def send_alert(self, facility_id, label, subject, body, avoid_resend=True):
         already_sent = False
         if (facility_id, label) in self.sent_alerts:
@@ -495,45 +1183,85 @@ class DeviceManager(object):
                 already_sent = True
         if not already_sent:
             assert facility_id in self.facilities
-            print('sending alert for facility: %s, subject: %s' % (facility_id, subject))
-            url = self.server_path + 'api/v1/facilities/%s/alert/send' % facility_id
-            payload = {'subject': subject, 'body': body}
-            r = self.send_request(requests.post, url, payload)
-            r.raise_for_status()
+            if self.local_sim:
+                print('alert for facility: %s, subject: %s' % (facility_id, subject))
+            else:
+                print('queueing alert for facility: %s, subject: %s' % (facility_id, subject))
+                self.alert_outbox.add(facility_id, label, subject, body)
+                self.alert_queued.set()
             if avoid_resend:
                 self.sent_alerts[(facility_id, label)] = time.time()
+                if self.alert_outbox:
+                    self.alert_outbox.mark_sent(facility_id, label, self.sent_alerts[(facility_id, label)])
 
     def clear_alert(self, facility_id, label):
         key = (facility_id, label)
         if key in self.sent_alerts:
             del self.sent_alerts[key]
+            if self.alert_outbox:
+                self.alert_outbox.clear_sent(facility_id, label)
 
-    # send a request to the server and retry if expired token
-    def send_request(self, request_func, url, json_payload=None):
-        # To be really robust this should probably timeout after some period to make sure the other greenlets
-        # get to run, but that also means gracefully handling just utterly failed attempts to talk to the server
-        # which will certainly happen if the internet goes down, but so for now, just hang here and keep going in case
-        # it ever comes back. Other devices shouldn't have timeouts or anything that prevent us from resuming if and
-        # when things come back, and it just means we'll miss a bunch of device samples - but that would happen in
-        # any case, it's just a question of which samples we end up missing.
-        #
-        # I'm actually not sure if Python lambdas / closures capture by reference or value or what, but safest just
-        # to say this lambda should NOT capture self.auth_header so we can pass it in every time and make sure it is
-        # using the new value every time.
+    # run this function as a greenlet; sends queued alerts, waiting a little after the first one arrives so that a burst of
+    # alerts (e.g. a power outage taking down a bunch of devices) goes out as one message per facility
+    def alert_outbox_loop(self):
+        backoff = self.server_session.backoff()
+        while True:
+            self.alert_queued.clear()
+            if not self.alert_outbox.pending_count():
+                self.alert_queued.wait()
+                gevent.sleep(self.alert_digest_delay)
+            if self.send_queued_alerts():
+                backoff.reset()
+            else:
+                backoff.sleep()
+
+    # send everything in the alert outbox, combining each facility's alerts into one message; returns false if any
+    # facility's alerts couldn't be sent (they stay queued)
+    def send_queued_alerts(self):
+        alerts_by_facility = defaultdict(list)
+        for seq, facility_id, label, subject, body, queued_at in self.alert_outbox.pending():
+            alerts_by_facility[facility_id].append((seq, label, subject, body))
+        all_sent = True
+        for facility_id, alerts in alerts_by_facility.items():
+            subject, body = alert_digest([alert[1:] for alert in alerts])
+            print('sending %d alert(s) for facility: %s, subject: %s' % (len(alerts), facility_id, subject))
+            url = self.server_path + 'api/v1/facilities/%s/alert/send' % facility_id
+            try:
+                r = self.send_request('POST', url, {'subject': subject, 'body': body})
+                r.raise_for_status()
+            except Exception as ex:
+                print('error sending alerts for facility %s: %s' % (facility_id, ex))
+                self.alert_failures_metric.inc()
+                all_sent = False
+                continue
+            self.alert_outbox.remove([alert[0] for alert in alerts])
+            self.alerts_sent_metric.inc(len(alerts))
+        return all_sent
+
+    # send a request to the server and retry if expired token; method is an HTTP method name such as 'GET' or 'POST'
+    def send_request(self, method, url, json_payload=None, headers=None):
+        # Connection errors, timeouts and transient server errors are retried a few times inside the server session (with
+        # backoff; for POSTs, only failures to connect) and then raised, so callers that must eventually succeed (e.g. loading config) do their own retry loops,
+        # while periodic work like uploading timeseries values just leaves things queued for the next round.
         #
-        # This - https://stackoverflow.com/questions/2295290/what-do-lambda-function-closures-capture - makes
-        # it sound like it's captured by reference and it would work to capture self.auth_header, but I think it
-        # makes the code more legible to pass it as an arg so I'm leaving it this way.
+        # We look up self.auth_header on every attempt rather than capturing it up front so that a retry after a token
+        # refresh uses the new token.
         while True:
+            if self.auth_header is None and not self.local_sim:  # startup; wait for the first access token
+                self.refresh_access_token_from_server()
+            auth_header = self.auth_header
             if self.diagnostic_mode:
-                print('Submitting request [{}, {}] with auth header [{}]'.format(request_func, url, abbreviate_string(self.auth_header, 30, 20)))
-            r = request_func(url, headers=self.auth_header, json=json_payload)
+                print('Submitting request [{}, {}] with auth header [{}]'.format(method, url, abbreviate_string(auth_header, 30, 20)))
+            request_headers = dict(auth_header or {}, **headers) if headers else auth_header
+            r = self.server_session.request(method, url, headers=request_headers, json=json_payload)
             if self.diagnostic_mode:
                 print('    Request sent: status {}, content {}'.format(r.status_code, r.content))
             if (r.status_code == 401):
+                self.unauthorized_metric.inc()
                 if self.diagnostic_mode:
                     print('    Expired token for request [{}], refreshing...'.format(r.request))
-                self.refresh_access_token_from_server()
+                if self.auth_header is auth_header:  # otherwise the token was already renewed while this request was in flight
+                    self.refresh_access_token_from_server()
             else:
                 if self.diagnostic_mode:
                     print('    Success, returning result')
@@ -541,6 +1269,23 @@ class DeviceManager(object):
                 return r
 
 
+BREAKER_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# device settings that a config reload can apply to a running device without recreating it
+RELOADABLE_SETTINGS = ('pollingInterval', 'pollingAlign', 'pollingJitter', 'pollTimeout', 'compression', 'aggregation')
+
+
+# a device or automation config with the given settings removed, for comparing the rest of the config
+def config_without_keys(info, setting_names):
+    settings = {k: v for k, v in (info.get('settings') or {}).items() if k not in setting_names}
+    return dict(info, settings=settings)
+
+
+# a string representation of an automation's config, used to tell which automations changed when config is reloaded
+def config_key(info):
+    return json.dumps(info, sort_keys=True)
+
+
 def abbreviate_string(thing_to_stringify, prefix, suffix):
     long_str = '{}'.format(thing_to_stringify)
     if len(long_str) > prefix+suffix:
@@ -12,7 +12,9 @@ class TerrawareDevice(ABC):
     @abstractmethod
     def get_timeseries_definitions(self) -> None:
         """This method should return a list of timeseries definitions, where each definition is a 4-tuple (another list), containing:
-            [device id, timeseries name, data type, decimal places] """
+            [device id, timeseries name, data type, decimal places]
+        optionally followed by a fifth element: a dictionary of compression settings for the series (see compression.py),
+        which are applied locally and not sent to the server."""
         ...
 
     @abstractmethod
@@ -35,6 +37,7 @@ class TerrawareDevice(ABC):
         self.expected_update_interval = 5 * 60  # used for watchdog
         self._polling_interval = None  # we won't poll the device unless the device class specifies a polling interval
 
+        self._settings = dev_info.get('settings') or {}
         self._local_sim = False
         if 'settings' in dev_info:
             settings = dev_info['settings']
@@ -60,24 +63,67 @@ class TerrawareDevice(ABC):
     def polling_interval(self):
         return self._polling_interval
 
+    @property
+    def configured_polling_interval(self):
+        """The polling interval set by the driver or by set_polling_interval. Devices that read some values more often than
+        others may report a shorter polling_interval than this."""
+        return self._polling_interval
+
+    @property
+    def settings(self):
+        return self._settings
+
     def set_local_sim(self, local_sim):
         self._local_sim = local_sim
 
     def set_polling_interval(self, polling_interval):
         self._polling_interval = polling_interval
 
+    def local_timeseries_names(self) -> list:
+        """Return the names of timeseries this device polls that are only kept locally (e.g. for automations to check) and
+        not defined on or sent to the server."""
+        return []
+
+    def set_settings(self, settings):
+        """Replace the device's settings; used when a config reload changes settings that can be applied while running."""
+        self._settings = settings
+
+    def shutdown(self) -> None:
+        """Called when the device is removed by a config reload. Override to release sockets, services, etc."""
+        ...
+
 
 class TerrawareHub(TerrawareDevice):
 
     def __init__(self, dev_info):
         super().__init__(dev_info)
         self._devices = []
+        self._devices_by_address = {}
 
     def add_device(self, device):
         if device.parent_id != self.id:
             print('Error: Trying to add device {} with parent_id {} to device {} with id {}, parent_id and id should match!'.format(device.name, device.parent_id, self.name, self.id))
         else:
             self._devices.append(device)
+            address = self.device_address(device)
+            if address is not None:
+                self._devices_by_address[address] = device
+
+    def device_address(self, device):
+        """Return the hardware address the hub uses to identify a child device, or None. Override if child devices
+        keep their address somewhere other than an address attribute."""
+        return getattr(device, 'address', None)
+
+    def device_by_address(self, address):
+        """Return the child device with the given hardware address, or None."""
+        return self._devices_by_address.get(address)
+
+    def remove_device(self, device):
+        if device in self._devices:
+            self._devices.remove(device)
+        address = self.device_address(device)
+        if address is not None and self._devices_by_address.get(address) is device:
+            del self._devices_by_address[address]
 
     @property
     def devices(self):
@@ -134,7 +134,7 @@ class ChirpStackHub(TerrawareHub):
 
     def process_uplink(self, dev_eui: str, payload: bytes):
         sensor_address = dev_eui.lower()
-        sensor = next((x for x in self.devices if x.address == sensor_address), None)
+        sensor = self.device_by_address(sensor_address)
         if sensor:
             sensor.receive_payload(payload)
  
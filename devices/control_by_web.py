@@ -78,7 +78,7 @@ class CBWWeatherStationDevice(TerrawareDevice):
         if self._local_sim:
             xml = self.sample_data()
         else:
-            r = requests.get('http://%s:%d/state.xml' % (self._host, self._port))
+            r = requests.get('http://%s:%d/state.xml' % (self._host, self._port), timeout=10)
             xml = r.text
         tree = ElementTree.fromstring(xml)
         state = {}
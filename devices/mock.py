@@ -1,16 +1,24 @@
 import json
+import random
 from .base import TerrawareDevice
 
 
 # this device loads sensor values from a file call mock.json on every polling loop; you can edit the file to change the values
+#
+# if the device settings include seriesCount, the device instead generates that many random walk series (value_0, value_1,
+# ...) in memory; the benchmarks use this to simulate large sites without a file read per poll
 class MockSensorDevice(TerrawareDevice):
 
     def __init__(self, dev_info):
         super().__init__(dev_info)
         self._polling_interval = 10
+        self._series_count = int(self.settings.get('seriesCount', 0))
+        self._series_values = [random.uniform(0, 100) for _ in range(self._series_count)]
         print('created MockSensorDevice')
 
     def get_timeseries_definitions(self):
+        if self._series_count:
+            return [[self.id, 'value_%d' % index, 'Numeric', 2] for index in range(self._series_count)]
         return [
             [self.id, 'value_a', 'Numeric', 2],
             [self.id, 'value_b', 'Numeric', 2],
@@ -20,6 +28,12 @@ class MockSensorDevice(TerrawareDevice):
         pass
 
     def poll(self):
+        if self._series_count:
+            values = {}
+            for index in range(self._series_count):
+                self._series_values[index] += random.uniform(-1, 1)
+                values[(self.id, 'value_%d' % index)] = self._series_values[index]
+            return values
         values = json.loads(open('mock.json').read())
         return {
             (self.id, 'value_a'): values['value_a'],
@@ -1,17 +1,40 @@
 import csv
+import math
 import time
 import random
+import struct
 import logging
 import pathlib
+from collections import deque, namedtuple
+from contextlib import contextmanager
 from typing import Optional
 
 import gevent
+from gevent.event import Event
 from pymodbus.client.sync import ModbusTcpClient
+from pymodbus.exceptions import ModbusException
+from pymodbus.pdu import ExceptionResponse
 from pymodbus.transaction import ModbusRtuFramer, ModbusSocketFramer
 
 from .base import TerrawareDevice, TerrawareHub
 
 
+MAX_REGISTERS_PER_READ = 125  # the most registers a single Modbus read can return (limited by the PDU size)
+DEFAULT_MAX_REGISTER_GAP = 32  # by default, read through up to this many unused registers to avoid another request
+DEFAULT_READ_RETRIES = 2  # by default, retry failed reads up to this many times per poll
+BUSY_EXCEPTION_CODES = (5, 6)  # exception responses (acknowledge, device busy) that mean the read may work if retried
+SPEC_PATH = str(pathlib.Path(__file__).parent.absolute()) + '/../specs'
+
+# struct format and number of 16-bit registers for each register data type
+REGISTER_TYPES = {
+    'uint16': ('H', 1),
+    'sint16': ('h', 1),
+    'uint32': ('I', 2),
+    'sint32': ('i', 2),
+    'float32': ('f', 2),
+}
+
+
 class ModbusDevice(TerrawareDevice):
 
     def __init__(self, dev_info, load_spec=True):
@@ -22,85 +45,412 @@ class ModbusDevice(TerrawareDevice):
 
         self._read_holding = False
         rtu_over_tcp = False
+        max_register_gap = DEFAULT_MAX_REGISTER_GAP
+        max_registers_per_read = MAX_REGISTERS_PER_READ
+        self._read_retries = DEFAULT_READ_RETRIES
         settings_items = dev_info.get('settings')
         if settings_items:
             if settings_items.get("unit"):
                 self._unit = settings_items["unit"]
             rtu_over_tcp = settings_items.get('rtu-over-tcp', False)
             self._read_holding = settings_items.get('holding', False)
+            max_register_gap = int(settings_items.get('maxRegisterGap', max_register_gap))
+            max_registers_per_read = min(int(settings_items.get('maxRegistersPerRead', max_registers_per_read)), MAX_REGISTERS_PER_READ)
+            self._read_retries = int(settings_items.get('readRetries', self._read_retries))
 
         framer = ModbusRtuFramer if rtu_over_tcp else ModbusSocketFramer
 
         port = dev_info["port"]
-        self._modbus_client = ModbusTcpClient(self._host, port=port, framer=framer)
-        self._seq_infos = []
+        self._gateway = get_gateway(self._host, port, framer)  # shared with other devices behind the same gateway
+
+        # load register info for this device make/model; devices of the same model share one register map
+        self._register_map = load_register_map(dev_info['make'], dev_info['model']) if load_spec else RegisterMap([])
+        self._registers = self._register_map.registers
 
-        # load register info for this device make/model
-        if load_spec:
-            spec_path = str(pathlib.Path(__file__).parent.absolute()) + '/../specs'
-            spec_file_name = spec_path + '/' + dev_info['make'] + '_' + dev_info['model'] + '.csv'
-            with open(spec_file_name) as csvfile:
-                lines = csv.DictReader(csvfile)
-                for line in lines:
-                    self._seq_infos.append(line)
+        # registers with their own poll interval in the spec are only read when they're due; the rest are read at the
+        # device's polling interval. We poll as often as the most frequently read registers need, reading only the registers
+        # that are due each time. Each group is keyed by its spec poll interval (None for the registers without one).
+        self._poll_intervals = sorted(set(register.poll_interval for register in self._registers if register.poll_interval))
+        self._poll_groups = (None, ) + tuple(self._poll_intervals)
+        self._next_due = {group: 0 for group in self._poll_groups}  # poll group -> time.monotonic() when next due
 
-        print('created modbus device (%s:%d, unit: %d)' % (self._host, port, self._unit))
+        # plan the reads for each combination of due registers: registers that are close together are read in one request
+        self._max_register_gap = max_register_gap
+        self._max_registers_per_read = max_registers_per_read
+        self._read_plans = {}  # tuple of due poll groups -> list of blocks (see plan_register_blocks)
+        self._contiguous_registers = set()  # indexes of registers the device won't let us read along with unused registers
+        self._separate_registers = set()  # indexes of registers the device won't let us read along with others
+
+        print('created modbus device (%s:%d, unit: %d, %d register(s) in %d read(s))' % (
+            self._host, port, self._unit, len(self._registers), len(self.read_plan(self._poll_groups))))
+
+    # how often we poll: the device's polling interval, or more often if some registers are read more often than that
+    @property
+    def polling_interval(self):
+        if self._poll_intervals and self._poll_intervals[0] < self._polling_interval:
+            return self._poll_intervals[0]
+        return self._polling_interval
 
     def get_timeseries_definitions(self):
-        return [[self.id, sequence['name'], 'Numeric', 2] for sequence in self._seq_infos]
+        return [[self.id, register.name, 'Numeric', register.decimal_places] for register in self._registers if register.send_to_server]
+
+    def local_timeseries_names(self):
+        return [register.name for register in self._registers if not register.send_to_server]
 
     def reconnect(self):
-        self._modbus_client.close()
-        gevent.sleep(0.5)
-        self._modbus_client.connect()
+        self._gateway.reconnect()
 
+    def shutdown(self):
+        release_gateway(self._gateway)
+
+    # Returns the values of the registers that were read successfully and passed their sanity checks, even if others
+    # failed. Only a transport-level failure (no response, or a garbled one, after retrying) triggers a reconnect.
     def poll(self):
-        if (not self._local_sim) and (not self._modbus_client.is_socket_open()):
-            self._modbus_client.connect()
+        if not self._local_sim:
+            self._gateway.ensure_connected()
+        now = time.monotonic()
+        due_groups = tuple(group for group in self._poll_groups if now + self.polling_interval / 2 >= self._next_due[group])
+        blocks = self.read_plan(due_groups)
+        raw_values, transport_failed = self.read_raw_values(blocks)
+        if not transport_failed:
+            for group in due_groups:
+                self._next_due[group] = now + (group or self._polling_interval)
+        expected_indexes = sorted(index for block in blocks for index in block[2])
         values = {}
-        for seq_info in self._seq_infos:
-            address = int(seq_info['address'], 0)
-            value = self.read_register(address, seq_info['type'], self._unit)
+        for index in expected_indexes:
+            register = self._registers[index]
+            value = raw_values.get(index)
             if value is not None:
-                value *= float(seq_info['scale_factor'])
-                values[(self.id, seq_info['name'])] = value
+                value *= register.scale
+                if not value_in_bounds(register, value):
+                    print('discarding out of range value from modbus device %s: %s = %s' % (self._host, register.name, value))
+                    self._gateway.rejected_value_count += 1
+                    continue
+                values[(self.id, register.name)] = value
                 if self._verbosity:
-                    print('    (%s, %s): %.2f' % (self.id, seq_info['name'], value))
-        if self._verbosity:
-            print('received %d of %d value(s) from %s' % (len(values), len(self._seq_infos), self._host))
-        if len(values) != len(self._seq_infos):
-            print('received fewer values than expected; reconnecting')
+                    print('    (%s, %s): %.2f' % (self.id, register.name, value))
+        if self._verbosity or len(values) != len(expected_indexes):
+            print('received %d of %d value(s) from %s (unit %d)' % (len(values), len(expected_indexes), self._host, self._unit))
+        if transport_failed:
+            print('lost contact with modbus device %s (unit %d); reconnecting' % (self._host, self._unit))
             self.reconnect()
-            values = {}  # when this happens, we seem to get corrupt data; don't want to store that
         return values
 
+    # the blocks to read when the given poll groups are due (see __init__)
+    def read_plan(self, due_groups):
+        blocks = self._read_plans.get(due_groups)
+        if blocks is None:
+            indexes = [index for index, register in enumerate(self._registers) if register.poll_interval in due_groups]
+            combined = [index for index in indexes if index not in self._contiguous_registers and index not in self._separate_registers]
+            contiguous = [index for index in indexes if index in self._contiguous_registers]
+            blocks = self.plan_blocks(combined, self._max_register_gap) + self.plan_blocks(contiguous, 0)
+            blocks += [(self._registers[index].address, self._registers[index].count, [index]) for index in indexes if index in self._separate_registers]
+            blocks.sort()
+            self._read_plans[due_groups] = blocks
+        return blocks
+
+    # group the registers with the given indexes into blocks (see plan_register_blocks), reading through at most max_gap
+    # unused registers
+    def plan_blocks(self, indexes, max_gap):
+        return [(start, count, [indexes[i] for i in block_indexes]) for start, count, block_indexes in plan_register_blocks(
+            [(self._registers[index].address, self._registers[index].count) for index in indexes], max_gap, self._max_registers_per_read)]
+
+    # Read the registers in the given blocks, one request per block. A read that gets no response, a garbled or short response,
+    # or a "busy" exception response is retried, up to the device's retry budget for the whole poll. If a read still fails
+    # at the transport level we stop there, since the rest would most likely time out too. Returns a dictionary of register
+    # index -> raw value, and whether there was a transport-level failure.
+    def read_raw_values(self, blocks):
+        raw_values = {}
+        retries_left = self._read_retries
+        pending_blocks = list(blocks)
+        while pending_blocks:
+            block = pending_blocks.pop(0)
+            start, count, indexes = block
+            if self._local_sim:
+                for index in indexes:
+                    raw_values[index] = random.randint(1, 100)
+                continue
+            try:
+                result = self.read_registers(start, count, self._unit)
+            except (ModbusException, OSError) as ex:
+                result = ex
+            if isinstance(result, ExceptionResponse) and result.exception_code not in BUSY_EXCEPTION_CODES:
+                if len(indexes) > 1:
+                    # Some devices reject reads that include unmapped registers; from now on read this block's registers in
+                    # runs of adjacent registers, or if it was already one run, separately.
+                    split_blocks = self.plan_blocks(indexes, 0)
+                    if len(split_blocks) > 1:
+                        print('modbus device %s rejected a read of %d registers at %d; reading adjacent registers together' % (self._host, count, start))
+                        self._contiguous_registers.update(indexes)
+                    else:
+                        print('modbus device %s rejected a read of %d registers at %d; reading them separately' % (self._host, count, start))
+                        split_blocks = [(self._registers[index].address, self._registers[index].count, [index]) for index in indexes]
+                        self._contiguous_registers.difference_update(indexes)
+                        self._separate_registers.update(indexes)
+                    blocks[blocks.index(block):blocks.index(block) + 1] = split_blocks
+                    self._read_plans = {due_groups: plan for due_groups, plan in self._read_plans.items() if plan is blocks}  # replan the others
+                    pending_blocks[:0] = split_blocks
+                else:
+                    print('modbus device %s rejected a read of register %s (exception code %d)' % (self._host, self._registers[indexes[0]].name, result.exception_code))
+                continue
+            registers = getattr(result, 'registers', None)
+            if registers is None or len(registers) < count:
+                if retries_left > 0:
+                    retries_left -= 1
+                    self._gateway.retry_count += 1
+                    pending_blocks.insert(0, block)
+                    continue
+                if isinstance(result, ExceptionResponse):  # still busy; the device is there, so no need to reconnect
+                    continue
+                print('failed to read %d register(s) at %d from modbus device %s: %s' % (count, start, self._host, result))
+                self._gateway.error_count += 1
+                return raw_values, True
+            data = registers_to_bytes(registers)
+            for index in indexes:
+                register = self._registers[index]
+                raw_values[index] = decode_register(register, data, (register.address - start) * 2)
+        return raw_values, False
+
+    # read count registers starting at address (input or holding registers, depending on the device settings); returns the
+    # pymodbus response
+    def read_registers(self, address, count, unit):
+        return self._gateway.read_registers(address, count, unit, self._read_holding)
+
     def read_register(self, address, register_type, unit):
         if self._local_sim:
             return random.randint(1, 100)
-        if register_type.endswith('32'):
-            count = 2
-        else:
-            count = 1
-        if self._read_holding:
-            result = self._modbus_client.read_holding_registers(address, count, unit=unit)
-        else:
-            result = self._modbus_client.read_input_registers(address, count, unit=unit)
+        register = compile_register({'name': '', 'address': str(address), 'type': register_type})
+        result = self.read_registers(address, register.count, unit)
         if not hasattr(result, 'registers'):
             return None
-        if register_type == 'uint16' and len(result.registers) >= 1:
-            return result.registers[0]
-        elif register_type == 'sint16' and len(result.registers) >= 1:
-            v = result.registers[0]
-            if v > 0x7fff:  # rough sign manipulation; should check/fix
-                v = v - 0x10000
-            return v
-        elif register_type == 'uint32' and len(result.registers) >= 2:
-            return result.registers[0] * 0x10000 + result.registers[1]
-        elif register_type == 'sint32' and len(result.registers) >= 2:
-            v = result.registers[0] * 0x10000 + result.registers[1]
-            if v > 0x7fffffff:  # rough sign manipulation; should check/fix
-                v = v - 0x100000000
-            return v
+        return decode_register(register, registers_to_bytes(result.registers), 0)
+
+
+# A connection to a Modbus TCP server or RTU-over-TCP gateway, shared by all the devices (unit ids) reached through it.
+# Requests are sent one at a time, in the order they were made: an RTU bus is half-duplex, so interleaving requests from
+# several devices garbles the responses. Requests to different gateways still run in parallel.
+class ModbusGateway(object):
+
+    def __init__(self, host, port, framer):
+        self.name = '%s:%d%s' % (host, port, '/rtu' if framer is ModbusRtuFramer else '')
+        self._client = ModbusTcpClient(host, port=port, framer=framer)
+        self._busy = False  # true while a greenlet has its turn on the gateway
+        self._waiters = deque()  # Events of greenlets waiting for their turn, in order
+        self._reconnect_count = 0
+        self.device_count = 0  # devices using this gateway
+        self.request_count = 0
+        self.request_seconds = 0.0  # total time requests spent on the bus
+        self.max_request_seconds = 0.0
+        self.wait_seconds = 0.0  # total time requests spent waiting for earlier requests
+        self.retry_count = 0  # reads retried after a failure
+        self.error_count = 0  # reads that still failed at the transport level after retrying
+        self.rejected_value_count = 0  # values discarded because they were outside the register's sanity bounds
+
+    # requests waiting for the gateway or in progress
+    @property
+    def queue_depth(self):
+        return len(self._waiters) + (1 if self._busy else 0)
+
+    # Wait for our turn on the gateway. Turns are handed directly from one greenlet to the next in the order they asked
+    # (gevent's locks let the greenlet releasing a lock take it straight back, so a device reading several blocks in a row
+    # could starve the others).
+    @contextmanager
+    def _turn(self):
+        if self._busy:
+            waiter = Event()
+            self._waiters.append(waiter)
+            try:
+                waiter.wait()
+            except BaseException:  # e.g. the poll timed out while waiting
+                if waiter.is_set():
+                    self._next_turn()
+                else:
+                    self._waiters.remove(waiter)
+                raise
         else:
-            print('unrecognized register data type: %s' % register_type)
-            return None
+            self._busy = True
+        try:
+            yield
+        finally:
+            self._next_turn()
+
+    def _next_turn(self):
+        if self._waiters:
+            self._waiters.popleft().set()
+        else:
+            self._busy = False
+
+    def read_registers(self, address, count, unit, holding=False):
+        queued_time = time.monotonic()
+        with self._turn():
+            start_time = time.monotonic()
+            self.wait_seconds += start_time - queued_time
+            try:
+                if holding:
+                    return self._client.read_holding_registers(address, count, unit=unit)
+                else:
+                    return self._client.read_input_registers(address, count, unit=unit)
+            finally:
+                elapsed = time.monotonic() - start_time
+                self.request_count += 1
+                self.request_seconds += elapsed
+                self.max_request_seconds = max(self.max_request_seconds, elapsed)
+
+    def ensure_connected(self):
+        if not self._client.is_socket_open():
+            with self._turn():
+                if not self._client.is_socket_open():
+                    self._client.connect()
+
+    # close and reopen the connection; if several devices behind the gateway ask at once, it's only done once
+    def reconnect(self):
+        reconnect_count = self._reconnect_count
+        with self._turn():
+            if self._reconnect_count != reconnect_count:
+                return
+            self._client.close()
+            gevent.sleep(0.5)
+            self._client.connect()
+            self._reconnect_count += 1
+
+    def close(self):
+        with self._turn():
+            self._client.close()
+
+
+_gateways = {}  # (host, port, framer) -> ModbusGateway
+
+
+def get_gateway(host, port, framer):
+    gateway = _gateways.get((host, port, framer))
+    if gateway is None:
+        gateway = _gateways[(host, port, framer)] = ModbusGateway(host, port, framer)
+    gateway.device_count += 1
+    return gateway
+
+
+# called when a device stops using a gateway; closes the gateway's connection once no devices are using it
+def release_gateway(gateway):
+    gateway.device_count -= 1
+    if gateway.device_count <= 0:
+        for key, value in list(_gateways.items()):
+            if value is gateway:
+                del _gateways[key]
+        gateway.close()
+
+
+def all_gateways():
+    return list(_gateways.values())
+
+
+# One register (or pair of registers) from a spec file, with everything needed to decode it worked out up front:
+#   decoder: struct.Struct that unpacks the value from big-endian bytes
+#   permutation: None if the device sends the value's words and bytes in big-endian order, otherwise the order in which
+#       to take the bytes as received to make them big-endian
+Register = namedtuple('Register', ['name', 'address', 'type', 'count', 'scale', 'send_to_server', 'decimal_places', 'min_value', 'max_value',
+                                   'poll_interval', 'decoder', 'permutation'])
+
+
+# The registers of one device make/model, compiled from its spec file. Register maps are shared by all devices of the
+# model, so they must not be modified.
+class RegisterMap(object):
+
+    def __init__(self, registers):
+        self.registers = tuple(registers)
+
+
+_register_maps = {}  # spec file name -> RegisterMap
+
+
+# get the register map for a device make/model, loading its spec file (specs/<make>_<model>.csv) the first time
+def load_register_map(make, model):
+    spec_file_name = SPEC_PATH + '/' + make + '_' + model + '.csv'
+    register_map = _register_maps.get(spec_file_name)
+    if register_map is None:
+        with open(spec_file_name) as csvfile:
+            try:
+                register_map = RegisterMap([compile_register(line) for line in csv.DictReader(csvfile)])
+            except ValueError as ex:
+                raise ValueError('error in modbus spec %s: %s' % (spec_file_name, ex))
+        _register_maps[spec_file_name] = register_map
+    return register_map
+
+
+# compile one row of a spec file. Columns: name, type (uint16, sint16, uint32, sint32 or float32), address, and optionally
+# scale_factor (default 1), send_to_server (default 1; 0 to read the register for automations without defining or
+# uploading it), decimal_places (default 2), word_order and byte_order (big or little, default big; little word order
+# means the low 16 bits of a 32-bit value come first), min and max (sanity bounds on the scaled value; values outside them
+# are assumed to be corrupt and discarded), and poll_interval (seconds between reads of this register, for registers that
+# should be read more or less often than the device's polling interval; if it's shorter, the device is polled that often,
+# but the other registers are still only read at the polling interval)
+def compile_register(line):
+    register_type = line['type']
+    if register_type not in REGISTER_TYPES:
+        raise ValueError('unrecognized register data type: %s' % register_type)
+    format_char, count = REGISTER_TYPES[register_type]
+    word_order = line.get('word_order') or 'big'
+    byte_order = line.get('byte_order') or 'big'
+    if word_order not in ('big', 'little') or byte_order not in ('big', 'little'):
+        raise ValueError('word_order and byte_order must be big or little (register %s)' % line['name'])
+    words = range(count) if word_order == 'big' else reversed(range(count))
+    permutation = tuple(word * 2 + byte for word in words for byte in ((0, 1) if byte_order == 'big' else (1, 0)))
+    return Register(
+        name=line['name'],
+        address=int(line['address'], 0),
+        type=register_type,
+        count=count,
+        scale=float(line.get('scale_factor') or 1),
+        send_to_server=bool(int(line.get('send_to_server') or 1)),
+        decimal_places=int(line.get('decimal_places') or 2),
+        min_value=float(line['min']) if line.get('min') else None,
+        max_value=float(line['max']) if line.get('max') else None,
+        poll_interval=float(line['poll_interval']) if line.get('poll_interval') else None,
+        decoder=struct.Struct('>' + format_char),
+        permutation=None if permutation == tuple(range(count * 2)) else permutation)
+
+
+# register values as returned by pymodbus, as the big-endian bytes they were sent as
+def registers_to_bytes(registers):
+    return struct.pack('>%dH' % len(registers), *registers)
+
+
+# decode a register's value from data (see registers_to_bytes) starting at the given byte offset; returns None if data
+# doesn't hold the whole value
+def decode_register(register, data, offset):
+    if offset + register.count * 2 > len(data):
+        return None
+    if register.permutation is None:
+        return register.decoder.unpack_from(data, offset)[0]
+    return register.decoder.unpack(bytes(data[offset + i] for i in register.permutation))[0]
+
+
+# check a scaled register value against the register's sanity bounds (and, for floats, that it's a number)
+def value_in_bounds(register, value):
+    if isinstance(value, float) and not math.isfinite(value):
+        return False
+    if register.min_value is not None and value < register.min_value:
+        return False
+    if register.max_value is not None and value > register.max_value:
+        return False
+    return True
+
+
+# Group registers into as few reads as possible. registers is a list of (address, register count); registers are read
+# together when the gap between them is at most max_gap unused registers and the whole read is at most max_count
+# registers. Returns a list of (start address, register count, indexes into registers) sorted by address.
+def plan_register_blocks(registers, max_gap=DEFAULT_MAX_REGISTER_GAP, max_count=MAX_REGISTERS_PER_READ):
+    blocks = []
+    start = end = None
+    indexes = []
+    for index in sorted(range(len(registers)), key=lambda i: registers[i]):
+        address, count = registers[index]
+        if indexes and address - end <= max_gap and max(end, address + count) - start <= max_count:
+            end = max(end, address + count)
+            indexes.append(index)
+        else:
+            if indexes:
+                blocks.append((start, end - start, indexes))
+            start, end, indexes = address, address + count, [index]
+    if indexes:
+        blocks.append((start, end - start, indexes))
+    return blocks
@@ -84,11 +84,11 @@ class OmniSenseHub(TerrawareHub):
                         }
                         device_id = self.device_manager.send_device_definition_to_server(dev_info)
                         dev_info['id'] = device_id
-                        device = OmniSenseTemperatureHumidityDevice(dev_info, False, False)
-                        self.device_manager.devices.append(device)
-                        self.add_device(device)
+                        device = OmniSenseTemperatureHumidityDevice(dev_info)
+                        self.device_manager.add_device(device)
+                        self.device_manager.link_device_to_hub(device)
                         timeseries_definitions = device.get_timeseries_definitions()
-                        self.device_manager.send_timeseries_definitions_to_server(timeseries_definitions)
+                        self.device_manager.send_timeseries_definitions_to_server(timeseries_definitions, wait=False)
                         print('done')
 
     def poll(self):
@@ -109,12 +109,10 @@ class OmniSenseHub(TerrawareHub):
             gevent.sleep(5)
 
     def find_device(self, sensor_addr):
-        result = None
-        for device in self.devices:
-            if device.sensor_addr == sensor_addr:
-                result = device
-                break
-        return result
+        return self.device_by_address(sensor_addr)
+
+    def device_address(self, device):
+        return device.sensor_addr
 
 
 class OmniSenseTemperatureHumidityDevice(TerrawareDevice):
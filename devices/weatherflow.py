@@ -41,18 +41,24 @@ class TempestWeatherStation(TerrawareDevice):
         if self._verbosity:
             print("running TempestWeatherStation in diagnostic mode")
         self._state = {}
+        self.sock = None
         if self._local_sim:
             self.update(getDataSet(test_message, 'metric', ignore_errors=True))  # do a quick test
-            gevent.spawn(self.sim)
+            self._receiver = gevent.spawn(self.sim)
         else:
             UDP_IP = "0.0.0.0"
             UDP_PORT = 50222
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.sock.bind((UDP_IP, UDP_PORT))
-            gevent.spawn(self.run)
+            self._receiver = gevent.spawn(self.run)
             if self._verbosity:
                 print("started weather station UDP receiver")
 
+    def shutdown(self):
+        self._receiver.kill()
+        if self.sock:
+            self.sock.close()
+
     def run(self):
         while True:
             data, addr = self.sock.recvfrom(1024)
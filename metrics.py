@@ -0,0 +1,181 @@
+import bisect
+
+from gevent.pywsgi import WSGIServer
+
+
+# Lightweight in-process metrics (counters, gauges and fixed-bucket histograms) with Prometheus text exposition. Updating a
+# metric is a dictionary lookup and an add, so these can be left on in production; nothing is formatted until the metrics
+# endpoint is scraped.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Metric(object):
+
+    metric_type = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+
+    # return a list of (name suffix, label values tuple, extra labels tuple, value) for exposition
+    def samples(self):
+        raise NotImplementedError
+
+
+# Counters and gauges either hold values that are updated directly, or (if func is given) call func when scraped, for
+# values that are already tracked elsewhere. func returns either a number, or a dictionary mapping label value tuples to
+# numbers.
+class ScalarMetric(Metric):
+
+    def __init__(self, name, help_text, label_names=(), func=None):
+        super().__init__(name, help_text, label_names)
+        self._values = {} if label_names else {(): 0}
+        self._func = func
+
+    def current_values(self):
+        if self._func is None:
+            return self._values
+        result = self._func()
+        return result if isinstance(result, dict) else {(): result}
+
+    def value(self, labels=()):
+        return self.current_values().get(labels, 0)
+
+    def samples(self):
+        return [('', labels, (), value) for labels, value in self.current_values().items()]
+
+
+class Counter(ScalarMetric):
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(ScalarMetric):
+
+    metric_type = 'gauge'
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def remove(self, labels=()):
+        self._values.pop(labels, None)
+
+
+class Histogram(Metric):
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self._buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, labels=()):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self._buckets) + 2)
+        series[bisect.bisect_left(self._buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, labels=()):
+        series = self._series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def sum(self, labels=()):
+        series = self._series.get(labels)
+        return series[-1] if series else 0.0
+
+    def samples(self):
+        samples = []
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets, series):
+                cumulative += bucket_count
+                samples.append(('_bucket', labels, (('le', format_value(bound)),), cumulative))
+            cumulative += series[len(self._buckets)]
+            samples.append(('_bucket', labels, (('le', '+Inf'),), cumulative))
+            samples.append(('_count', labels, (), cumulative))
+            samples.append(('_sum', labels, (), series[-1]))
+        return samples
+
+
+class MetricsRegistry(object):
+
+    def __init__(self, prefix='device_manager_'):
+        self._prefix = prefix
+        self._metrics = []
+
+    def counter(self, name, help_text, label_names=(), func=None):
+        return self._register(Counter(self._prefix + name, help_text, label_names, func))
+
+    def gauge(self, name, help_text, label_names=(), func=None):
+        return self._register(Gauge(self._prefix + name, help_text, label_names, func))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DURATION_BUCKETS):
+        return self._register(Histogram(self._prefix + name, help_text, label_names, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    # Prometheus text exposition format, version 0.0.4
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+            lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+            for suffix, label_values, extra_labels, value in metric.samples():
+                label_pairs = list(zip(metric.label_names, label_values)) + list(extra_labels)
+                if label_pairs:
+                    label_text = '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(label_value)) for name, label_value in label_pairs)
+                else:
+                    label_text = ''
+                lines.append('%s%s%s %s' % (metric.name, suffix, label_text, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    # values of the metrics that have no labels, keyed by metric name (without prefix); histograms contribute _count and
+    # _sum entries. Used to record the device manager's own health as timeseries.
+    def scalar_values(self):
+        values = {}
+        for metric in self._metrics:
+            if metric.label_names:
+                continue
+            short_name = metric.name[len(self._prefix):]
+            if isinstance(metric, Histogram):
+                values[short_name + '_count'] = metric.count()
+                values[short_name + '_sum'] = metric.sum()
+            else:
+                values[short_name] = metric.value()
+        return values
+
+    # serve the metrics over HTTP at /metrics; returns the started server
+    def serve(self, port, host='127.0.0.1'):
+        def app(environ, start_response):
+            if environ.get('PATH_INFO', '/') not in ('/', '/metrics'):
+                start_response('404 Not Found', [('Content-Type', 'text/plain')])
+                return [b'not found\n']
+            body = self.render().encode()
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'), ('Content-Length', str(len(body)))])
+            return [body]
+        server = WSGIServer((host, port), app, log=None)
+        server.start()
+        return server
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
@@ -0,0 +1,140 @@
+import time
+import heapq
+import random
+import itertools
+
+import gevent
+from gevent.event import Event
+
+
+# timing statistics for one device's scheduled polls
+class PollStats(object):
+
+    def __init__(self):
+        self.poll_count = 0
+        self.total_lateness = 0.0  # seconds between when a poll was due and when it started
+        self.max_lateness = 0.0
+        self.last_lateness = 0.0
+        self.last_duration = 0.0  # seconds the most recent poll took
+        self.overrun_count = 0  # slots skipped because the previous poll was still running
+        self.missed_count = 0  # slots skipped because the scheduler itself fell behind
+        self.blocked_count = 0  # slots skipped because the device wasn't ready to be polled (e.g. its circuit breaker was open)
+
+    @property
+    def mean_lateness(self):
+        return self.total_lateness / self.poll_count if self.poll_count else 0.0
+
+    def record(self, lateness):
+        self.poll_count += 1
+        self.total_lateness += lateness
+        self.last_lateness = lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+
+    def summary(self):
+        return 'polls: %d, lateness mean: %.3fs, max: %.3fs, last duration: %.3fs, overruns: %d, missed: %d, blocked: %d' % (
+            self.poll_count, self.mean_lateness, self.max_lateness, self.last_duration, self.overrun_count, self.missed_count, self.blocked_count)
+
+
+class ScheduledPoll(object):
+
+    def __init__(self, device, deadline):
+        self.device = device
+        self.deadline = deadline  # time.monotonic() value when the next poll is due
+        self.stats = PollStats()
+        self.greenlet = None  # greenlet running the current/most recent poll
+        self.removed = False
+
+
+# Polls devices on fixed deadlines rather than sleeping for the polling interval after each poll, so poll duration doesn't
+# accumulate as drift. Deadlines are kept in a heap ordered by time.monotonic(), and a single scheduler greenlet sleeps until
+# the earliest one is due. Each poll runs in its own greenlet so a slow device doesn't delay the others; if a device's
+# previous poll is still running when its next one is due, that slot is skipped and counted as an overrun.
+#
+# The interval is read from device.polling_interval each time a poll is scheduled, so changing it takes effect after the
+# next poll; setting it to zero or None stops polling the device.
+class PollScheduler(object):
+
+    def __init__(self, poll_func, ready_func=None):
+        self._poll_func = poll_func  # called with the device to poll
+        self._ready_func = ready_func  # optional; called with the device when a poll is due, and the poll is skipped if it returns false
+        self._heap = []
+        self._sequence = itertools.count()  # tie breaker so the heap never compares devices
+        self._entries = {}  # device id -> ScheduledPoll
+        self._wakeup = Event()
+
+    # Start polling a device. If align is set, polls happen at wall clock multiples of the polling interval (e.g. on the minute
+    # for a 60 second interval). Each device also gets a fixed random offset of up to jitter seconds so that devices with the
+    # same interval don't all poll in the same instant.
+    def add(self, device, align=False, jitter=0.0):
+        interval = device.polling_interval
+        offset = random.uniform(0, min(jitter, interval)) if jitter else 0.0
+        deadline = time.monotonic() + offset
+        if align:
+            deadline += (interval - time.time() % interval) % interval
+        entry = ScheduledPoll(device, deadline)
+        self._entries[device.id] = entry
+        self._push(entry)
+
+    def remove(self, device):
+        entry = self._entries.pop(device.id, None)
+        if entry:
+            entry.removed = True  # left in the heap and discarded when it comes up
+
+    def stats(self, device):
+        entry = self._entries.get(device.id)
+        return entry.stats if entry else None
+
+    def all_stats(self):
+        return {device_id: entry.stats for device_id, entry in self._entries.items()}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _push(self, entry):
+        heapq.heappush(self._heap, (entry.deadline, next(self._sequence), entry))
+        self._wakeup.set()
+
+    # run this function as a greenlet
+    def run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                self._wakeup.wait()
+                continue
+            deadline, _, entry = self._heap[0]
+            now = time.monotonic()
+            if deadline > now:
+                self._wakeup.clear()
+                self._wakeup.wait(deadline - now)  # woken early if a device with an earlier deadline is added
+                continue
+            heapq.heappop(self._heap)
+            if entry.removed:
+                continue
+
+            if entry.greenlet and not entry.greenlet.dead:
+                entry.stats.overrun_count += 1
+            elif self._ready_func and not self._ready_func(entry.device):
+                entry.stats.blocked_count += 1
+            else:
+                entry.stats.record(now - deadline)
+                entry.greenlet = gevent.spawn(self._timed_poll, entry)
+
+            interval = entry.device.polling_interval
+            if not interval:
+                self._entries.pop(entry.device.id, None)
+                continue
+            next_deadline = deadline + interval
+            if next_deadline <= now:  # fell behind by more than a whole interval; skip the slots we missed rather than bursting
+                missed = int((now - next_deadline) // interval) + 1
+                entry.stats.missed_count += missed
+                next_deadline += missed * interval
+            entry.deadline = next_deadline
+            self._push(entry)
+
+    def _timed_poll(self, entry):
+        start_time = time.monotonic()
+        try:
+            self._poll_func(entry.device)
+        finally:
+            entry.stats.last_duration = time.monotonic() - start_time
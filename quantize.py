@@ -0,0 +1,35 @@
+import decimal
+
+
+DEFAULT_DECIMAL_PLACES = 2
+
+# Rounding a float with round() gives the same digits as rounding the float's exact value as a Decimal (both round half
+# to even), and as long as the rounded result has at most 15 significant digits, the float's shortest repr is exactly
+# those digits. So below these magnitudes (indexed by decimal places) plain float rounding is exact and we can skip
+# Decimal, which is several times slower.
+FAST_PATH_LIMITS = [10.0 ** (15 - places) for places in range(16)]
+
+
+# round a single value to the given number of decimal places; non-float values are returned unchanged
+def quantize(value, decimal_places):
+    if value.__class__ is not float:
+        return value
+    if decimal_places < len(FAST_PATH_LIMITS) and -FAST_PATH_LIMITS[decimal_places] < value < FAST_PATH_LIMITS[decimal_places]:
+        return round(value, decimal_places) if decimal_places else round(value)
+    if value != value or value in (float('inf'), float('-inf')):
+        return value
+    return round(decimal.Decimal(value), decimal_places)
+
+
+# round the float values in a dictionary of (device id, timeseries name) -> value, in place, using the decimal places
+# from the precision table (also keyed by (device id, timeseries name)) or the default if a series isn't in the table
+def quantize_values(values, precision_table, default_decimal_places=DEFAULT_DECIMAL_PLACES):
+    limits = FAST_PATH_LIMITS
+    for key, value in values.items():
+        if value.__class__ is float:
+            decimal_places = precision_table.get(key, default_decimal_places)
+            if decimal_places and decimal_places < 16 and -limits[decimal_places] < value < limits[decimal_places]:
+                values[key] = round(value, decimal_places)  # fast path, inlined from quantize()
+            else:
+                values[key] = quantize(value, decimal_places)
+    return values
@@ -0,0 +1,161 @@
+import time
+import random
+
+import gevent
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+
+# status codes that indicate a transient server-side problem worth retrying
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+# methods that are safe to send again if we don't know whether the server handled the first attempt; other requests (e.g.
+# POSTs of timeseries values or alerts) are only retried if the connection couldn't be opened, so they're never sent twice
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+
+# exponential backoff with "full jitter": each delay is a random amount between zero and an exponentially growing cap,
+# so a fleet of devices that lost connectivity at the same moment doesn't come back in lockstep
+class Backoff(object):
+
+    def __init__(self, base_delay=1.0, max_delay=120.0):
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._attempt = 0
+
+    def next_delay(self):
+        delay = random.uniform(0, min(self._max_delay, self._base_delay * (2 ** self._attempt)))
+        self._attempt += 1
+        return delay
+
+    def sleep(self):
+        gevent.sleep(self.next_delay())
+
+    def reset(self):
+        self._attempt = 0
+
+
+# running count/total/max of a latency measurement in seconds
+class LatencyStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return 'count: %d, mean: %.3fs, max: %.3fs' % (self.count, self.mean, self.max)
+
+
+# urllib3 connection pool classes whose connections time how long it takes to open the TCP connection (and do the TLS
+# handshake, for https); with keep-alive working this should be rare compared to the number of requests
+def timed_pool_classes(handshake_stats):
+
+    class TimedHTTPConnection(HTTPConnection):
+        def connect(self):
+            start_time = time.time()
+            super().connect()
+            handshake_stats.record(time.time() - start_time)
+
+    class TimedHTTPSConnection(HTTPSConnection):
+        def connect(self):
+            start_time = time.time()
+            super().connect()
+            handshake_stats.record(time.time() - start_time)
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    return {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+
+    def __init__(self, handshake_stats, **kwargs):
+        self._handshake_stats = handshake_stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = timed_pool_classes(self._handshake_stats)
+
+
+# A keep-alive HTTP session used for all communication with terraware-server (and the token endpoint), so that we pay for
+# TCP and TLS setup once per connection rather than once per request. Every request has connect/read timeouts, and
+# connection errors, timeouts and transient server errors are retried a few times with exponential backoff (for
+# non-idempotent requests, only failures to connect; see IDEMPOTENT_METHODS).
+class ServerSession(object):
+
+    def __init__(self, connect_timeout=10.0, read_timeout=60.0, max_retries=3, max_retry_delay=120.0, pool_size=8):
+        self._timeout = (connect_timeout, read_timeout)
+        self._max_retries = max_retries
+        self._max_retry_delay = max_retry_delay
+        self.handshake_stats = LatencyStats()  # time to open new connections
+        self.request_stats = LatencyStats()  # time for each request, including any time spent opening a connection
+        self.retry_count = 0
+        self.error_count = 0
+        self._session = requests.Session()
+        adapter = TimedHTTPAdapter(self.handshake_stats, pool_connections=4, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    # make a backoff helper using this session's retry settings, for callers that retry whole operations
+    def backoff(self):
+        return Backoff(max_delay=self._max_retry_delay)
+
+    # send a request, retrying connection errors, timeouts and transient server errors; other errors are left to the caller
+    def request(self, method, url, headers=None, json=None, data=None, timeout=None, max_retries=None):
+        if max_retries is None:
+            max_retries = self._max_retries
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        backoff = self.backoff()
+        attempt = 0
+        while True:
+            start_time = time.time()
+            try:
+                r = self._session.request(method, url, headers=headers, json=json, data=data, timeout=timeout or self._timeout)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                self.error_count += 1
+                if attempt >= max_retries or not (idempotent or is_connect_error(ex)):
+                    raise
+                print('error sending %s request to %s: %s; retrying' % (method, url, ex))
+            else:
+                self.request_stats.record(time.time() - start_time)
+                if r.status_code not in RETRY_STATUS_CODES or attempt >= max_retries or not idempotent:
+                    return r
+                self.error_count += 1
+                print('server returned status %d for %s request to %s; retrying' % (r.status_code, method, url))
+            attempt += 1
+            self.retry_count += 1
+            backoff.sleep()
+
+    def summary(self):
+        return 'requests: %s; new connections: %s; retries: %d; errors: %d' % (
+            self.request_stats.summary(), self.handshake_stats.summary(), self.retry_count, self.error_count)
+
+
+# true if a request failed before it reached the server (couldn't connect, or timed out connecting), so sending it again
+# can't duplicate it
+def is_connect_error(ex):
+    if isinstance(ex, requests.ConnectTimeout):
+        return True
+    reason = getattr(ex.args[0], 'reason', None) if ex.args else None
+    return isinstance(reason, NewConnectionError)
@@ -0,0 +1,95 @@
+import pytest
+
+import devices.modbus as modbus
+from devices.modbus import ModbusDevice, RegisterMap, compile_register
+
+
+class Response(object):
+
+    def __init__(self, registers):
+        self.registers = registers
+
+
+# a device of a made-up model with the given spec rows, whose gateway reads come from fake_read(address, count) and are
+# recorded in device.reads
+def make_device(monkeypatch, rows, fake_read=None, settings=None):
+    register_map = RegisterMap([compile_register(row) for row in rows])
+    monkeypatch.setitem(modbus._register_maps, modbus.SPEC_PATH + '/Test_Test.csv', register_map)
+    device = ModbusDevice({'id': 1, 'name': 'test', 'facilityId': 1, 'make': 'Test', 'model': 'Test', 'address': 'test-%d' % id(rows),
+                           'port': 502, 'settings': settings or {}})
+    device.reads = []
+
+    def read_registers(address, count, unit, holding=False):
+        device.reads.append((address, count))
+        return fake_read(address, count) if fake_read else Response([address] * count)
+
+    monkeypatch.setattr(device._gateway, 'read_registers', read_registers)
+    monkeypatch.setattr(device._gateway, 'ensure_connected', lambda: None)
+    return device
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(modbus.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_fast_rows_do_not_speed_up_default_rows(monkeypatch, clock):
+    rows = [
+        {'name': 'fast', 'type': 'uint16', 'address': '0', 'poll_interval': '5'},
+        {'name': 'default', 'type': 'uint16', 'address': '100'},
+    ]
+    device = make_device(monkeypatch, rows, settings={'maxRegisterGap': 0})
+    assert device.polling_interval == 5
+    assert device.configured_polling_interval == 60
+    counts = {'fast': 0, 'default': 0}
+    for _ in range(24):  # two minutes of polls
+        for (device_id, name) in device.poll():
+            counts[name] += 1
+        clock[0] += device.polling_interval
+    assert counts['fast'] == 24
+    assert counts['default'] == 2
+
+
+def test_rejected_gap_read_falls_back_to_adjacent_registers(monkeypatch, clock):
+    rows = [
+        {'name': 'a', 'type': 'uint16', 'address': '10'},
+        {'name': 'b', 'type': 'uint32', 'address': '11'},
+        {'name': 'c', 'type': 'uint16', 'address': '20'},
+        {'name': 'd', 'type': 'uint16', 'address': '21'},
+    ]
+
+    def fake_read(address, count):
+        if address + count > 13 and address < 20:  # reads including the unmapped registers 13-19 are rejected
+            return modbus.ExceptionResponse(4, 2)
+        return Response(list(range(address, address + count)))
+
+    device = make_device(monkeypatch, rows, fake_read)
+    values = device.poll()
+    assert values == {(1, 'a'): 10, (1, 'b'): (11 << 16) + 12, (1, 'c'): 20, (1, 'd'): 21}
+    assert device.reads == [(10, 12), (10, 3), (20, 2)]
+    device.reads.clear()
+    clock[0] += device.polling_interval
+    assert device.poll() == values
+    assert device.reads == [(10, 3), (20, 2)]
+
+
+def test_rejected_adjacent_registers_are_read_separately(monkeypatch, clock):
+    rows = [
+        {'name': 'a', 'type': 'uint16', 'address': '10'},
+        {'name': 'b', 'type': 'uint16', 'address': '11'},
+        {'name': 'c', 'type': 'uint16', 'address': '20'},
+    ]
+
+    def fake_read(address, count):
+        if count > 1:
+            return modbus.ExceptionResponse(4, 2)
+        return Response([address])
+
+    device = make_device(monkeypatch, rows, fake_read)
+    assert device.poll() == {(1, 'a'): 10, (1, 'b'): 11, (1, 'c'): 20}
+    device.reads.clear()
+    clock[0] += device.polling_interval
+    device.poll()
+    assert device.reads == [(10, 1), (11, 1), (20, 1)]
@@ -0,0 +1,34 @@
+from timeseries_buffer import TimeseriesBuffer, DOWNSAMPLE
+
+KEY = (1, 'value')
+
+
+def test_downsample_keeps_oldest_and_newest_values():
+    buffer = TimeseriesBuffer(max_samples=100, eviction_policy=DOWNSAMPLE)
+    for ts in range(1000):
+        buffer.append({KEY: ts}, ts)
+    timestamps, values = buffer.drain()[KEY]
+    assert timestamps[0] == 0
+    assert timestamps[-1] == 999
+    assert list(values) == list(timestamps)
+    assert len(timestamps) <= 100
+    assert list(timestamps) == sorted(set(timestamps))
+
+
+def test_downsample_per_series_limit_keeps_oldest_and_newest_values():
+    buffer = TimeseriesBuffer(max_samples_per_series=50, eviction_policy=DOWNSAMPLE)
+    for ts in range(1000):
+        buffer.append_point(KEY, ts, ts)
+    assert buffer.sample_count <= 50
+    timestamps, values = buffer.drain()[KEY]
+    assert (timestamps[0], timestamps[-1]) == (0, 999)
+    assert len(timestamps) == len(values)
+
+
+def test_downsample_drops_every_other_interior_value():
+    buffer = TimeseriesBuffer(max_samples_per_series=5, eviction_policy=DOWNSAMPLE)
+    for ts in range(6):
+        buffer.append({KEY: ts}, ts)
+    timestamps, values = buffer.drain()[KEY]
+    assert list(timestamps) == [0, 2, 4, 5]
+    assert buffer.evicted_count == 2
@@ -0,0 +1,194 @@
+import datetime
+from collections import deque
+from datetime import timezone
+
+
+# Rough memory cost of one buffered value: the timestamp and value objects plus their slots in the two columns. Strings
+# add their length. This is only used to enforce the byte budget, so it doesn't need to be exact.
+SAMPLE_BYTES = 100
+
+OLDEST_FIRST = 'oldest'
+DOWNSAMPLE = 'downsample'
+
+
+def sample_bytes(value):
+    return SAMPLE_BYTES + len(value) if value.__class__ is str else SAMPLE_BYTES
+
+
+# Holds timeseries values waiting to be sent to the server. Values are stored per series as two parallel columns
+# (epoch timestamps and raw values) so that recording a poll result is a dictionary lookup and two appends; the JSON
+# shape the server wants is only built when we actually send.
+#
+# The buffer is bounded three ways, so that a long outage (or a spool that can't be written) can't run us out of memory:
+# each series holds at most max_samples_per_series values, and the estimated size and total number of values are kept
+# under max_bytes and max_samples. When one of the totals is exceeded, the longest series are cut back first, so one
+# chatty series can't push everyone else's data out. The eviction policy either drops the oldest values (OLDEST_FIRST)
+# or drops every other value apart from the oldest and newest (DOWNSAMPLE), which keeps the whole time range at lower
+# resolution; the same goes for a series that reaches its own limit. When a total is exceeded we cut back to 90% of the
+# limit so we aren't evicting on every append.
+class TimeseriesBuffer(object):
+
+    def __init__(self, max_samples=None, max_samples_per_series=None, max_bytes=None, eviction_policy=OLDEST_FIRST):
+        if eviction_policy not in (OLDEST_FIRST, DOWNSAMPLE):
+            raise ValueError('unknown eviction policy: %s' % eviction_policy)
+        self._series = {}  # (device id, timeseries name) -> (deque of epoch timestamps, deque of values)
+        self._sample_count = 0
+        self._byte_count = 0
+        self._max_samples = max_samples
+        self._max_samples_per_series = max_samples_per_series
+        self._max_bytes = max_bytes
+        self._eviction_policy = eviction_policy
+        self.evicted_count = 0  # values dropped because the buffer was over one of its limits
+
+    # number of series with pending values
+    def __len__(self):
+        return len(self._series)
+
+    @property
+    def sample_count(self):
+        return self._sample_count
+
+    # estimated memory used by buffered values, in bytes
+    @property
+    def byte_count(self):
+        return self._byte_count
+
+    def _new_columns(self):
+        return deque(maxlen=self._max_samples_per_series), deque(maxlen=self._max_samples_per_series)
+
+    # values is a dictionary that maps from the tuple (device id, timeseries name) -> value
+    def append(self, values, timestamp):
+        series = self._series
+        max_per_series = self._max_samples_per_series
+        added_bytes = 0
+        for key, value in values.items():
+            columns = series.get(key)
+            if columns is None:
+                columns = series[key] = self._new_columns()
+            elif len(columns[0]) == max_per_series:
+                columns = self._make_room(key)
+            columns[0].append(timestamp)
+            columns[1].append(value)
+            added_bytes += sample_bytes(value)
+        self._sample_count += len(values)
+        self._byte_count += added_bytes
+        self._enforce_limits()
+
+    # add a single value, e.g. one that compression held back and has now decided to keep
+    def append_point(self, key, timestamp, value):
+        columns = self._series.get(key)
+        if columns is None:
+            columns = self._series[key] = self._new_columns()
+        elif len(columns[0]) == self._max_samples_per_series:
+            columns = self._make_room(key)
+        columns[0].append(timestamp)
+        columns[1].append(value)
+        self._byte_count += sample_bytes(value)
+        self._sample_count += 1
+        self._enforce_limits()
+
+    # remove and return everything in the buffer; the result can be passed to restore() if sending fails
+    def drain(self):
+        series = self._series
+        self._series = {}
+        self._sample_count = 0
+        self._byte_count = 0
+        return series
+
+    # put previously drained values back in front of anything recorded since they were drained
+    def restore(self, series):
+        newer = self._series
+        self._series = series
+        for key, (timestamps, values) in newer.items():
+            columns = series.get(key)
+            if columns is None:
+                series[key] = (timestamps, values)
+            else:
+                if self._eviction_policy == DOWNSAMPLE and self._max_samples_per_series:
+                    while len(columns[0]) > 1 and len(columns[0]) + len(timestamps) > self._max_samples_per_series:
+                        self._downsample(key)
+                        columns = series[key]
+                dropped = max(0, len(columns[0]) + len(timestamps) - self._max_samples_per_series) if self._max_samples_per_series else 0
+                self.evicted_count += dropped
+                columns[0].extend(timestamps)
+                columns[1].extend(values)
+        self._sample_count = sum(len(columns[0]) for columns in series.values())
+        self._byte_count = sum(sample_bytes(value) for columns in series.values() for value in columns[1])
+        self._enforce_limits()
+
+    # make room for one more value in a full series: the ring buffer would drop its oldest value, or with DOWNSAMPLE we drop
+    # every other value instead; returns the series' columns
+    def _make_room(self, key):
+        if self._eviction_policy == DOWNSAMPLE:
+            self._downsample(key)
+        else:
+            timestamps, values = self._series[key]
+            self._byte_count -= sample_bytes(values[0])
+            self._sample_count -= 1
+            self.evicted_count += 1
+        return self._series[key]
+
+    def _remove_series(self, key):
+        timestamps, values = self._series.pop(key)
+        self._sample_count -= len(timestamps)
+        self._byte_count -= sum(sample_bytes(value) for value in values)
+        self.evicted_count += len(timestamps)
+
+    def _over_limit(self, fraction=1.0):
+        return (self._max_bytes is not None and self._byte_count > self._max_bytes * fraction) or \
+               (self._max_samples is not None and self._sample_count > self._max_samples * fraction)
+
+    def _enforce_limits(self):
+        if not self._over_limit():
+            return
+        while self._series and self._over_limit(0.9):
+            key = max(self._series, key=lambda k: len(self._series[k][0]))
+            timestamps, values = self._series[key]
+            if len(timestamps) <= 1:
+                self._remove_series(key)
+            elif self._eviction_policy == DOWNSAMPLE:
+                self._downsample(key)
+            else:
+                excess_samples = self._sample_count - self._max_samples * 0.9 if self._max_samples is not None else 0
+                excess_bytes = (self._byte_count - self._max_bytes * 0.9) / SAMPLE_BYTES if self._max_bytes is not None else 0
+                drop_count = min(len(timestamps) // 2, max(1, int(max(excess_samples, excess_bytes)) + 1))
+                for _ in range(drop_count):
+                    timestamps.popleft()
+                    self._byte_count -= sample_bytes(values.popleft())
+                self._sample_count -= drop_count
+                self.evicted_count += drop_count
+
+    # drop every other value of a series, always keeping the oldest and newest so the series still covers the same time
+    # range (a series of two values just keeps the newest)
+    def _downsample(self, key):
+        timestamps, values = self._series[key]
+        count = len(timestamps)
+        kept_indexes = list(range(0, count - 1, 2)) + [count - 1] if count > 2 else [count - 1]
+        all_timestamps = list(timestamps)
+        all_values = list(values)
+        kept_timestamps = [all_timestamps[i] for i in kept_indexes]
+        kept_values = [all_values[i] for i in kept_indexes]
+        dropped_count = count - len(kept_indexes)
+        self._byte_count -= sum(sample_bytes(value) for value in all_values) - sum(sample_bytes(value) for value in kept_values)
+        self._sample_count -= dropped_count
+        self.evicted_count += dropped_count
+        self._series[key] = (deque(kept_timestamps, maxlen=self._max_samples_per_series), deque(kept_values, maxlen=self._max_samples_per_series))
+
+
+# convert drained buffer contents into the list of entries expected by the api/v1/timeseries/values endpoint
+def server_timeseries_entries(series):
+    iso_timestamps = {}  # most series share the same handful of poll timestamps, so only format each one once
+    entries = []
+    for (device_id, timeseries_name), (timestamps, values) in series.items():
+        server_values = []
+        for ts, value in zip(timestamps, values):
+            iso_timestamp = iso_timestamps.get(ts)
+            if iso_timestamp is None:
+                iso_timestamp = iso_timestamps[ts] = datetime.datetime.fromtimestamp(ts, timezone.utc).isoformat()
+            server_values.append({'timestamp': iso_timestamp, 'value': str(value)})
+        entries.append({
+            'deviceId': device_id,
+            'timeseriesName': timeseries_name,
+            'values': server_values,
+        })
+    return entries
@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+
+
+# Keeps track of which timeseries definitions the server already has, so we only send new or changed definitions instead of
+# every definition on every startup. For each registered series we store a hash of the definition we sent; the registry is
+# saved to a JSON file along with the server address (registrations for a different server don't count). Definitions
+# waiting to be sent are kept in a pending queue, so a failed request only needs to resend the entries that didn't make it.
+class TimeseriesRegistry(object):
+
+    def __init__(self, path, server):
+        self.path = path
+        self._server = server
+        self._registered = {}  # "device id/timeseries name" -> definition hash
+        self._pending = {}  # (device id, timeseries name) -> server entry, in the order they were queued
+        self.rejected_count = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path) as registry_file:
+                    contents = json.load(registry_file)
+                if contents.get('server') == server:
+                    self._registered = contents['registered']
+            except (OSError, ValueError, KeyError) as ex:
+                print('error reading timeseries registry %s: %s; ignoring it' % (path, ex))
+
+    def __len__(self):
+        return len(self._registered)
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    # queue the server entries (as sent to api/v1/timeseries/create) that the server doesn't have yet or that have changed;
+    # returns the number of entries queued
+    def queue(self, entries):
+        count = 0
+        for entry in entries:
+            key = (entry['deviceId'], entry['timeseriesName'])
+            if self._registered.get(registry_key(key)) != entry_hash(entry):
+                self._pending[key] = entry
+                count += 1
+        return count
+
+    # the oldest pending entries, up to limit
+    def pending(self, limit):
+        entries = []
+        for entry in self._pending.values():
+            if len(entries) >= limit:
+                break
+            entries.append(entry)
+        return entries
+
+    # record that the server accepted these entries
+    def mark_registered(self, entries):
+        for entry in entries:
+            key = (entry['deviceId'], entry['timeseriesName'])
+            if self._pending.get(key) is entry:  # unless a newer definition was queued while this one was being sent
+                del self._pending[key]
+            self._registered[registry_key(key)] = entry_hash(entry)
+        self.save()
+
+    # give up on entries the server won't accept; they're queued again if their definition changes or the series is seen
+    # again after a restart
+    def reject(self, entries):
+        for entry in entries:
+            key = (entry['deviceId'], entry['timeseriesName'])
+            if self._pending.get(key) is entry:
+                del self._pending[key]
+                self.rejected_count += 1
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as registry_file:
+                json.dump({'server': self._server, 'registered': self._registered}, registry_file)
+            os.replace(temp_path, self.path)
+        except OSError as ex:
+            print('error writing timeseries registry %s: %s' % (self.path, ex))
+
+
+def registry_key(key):
+    return '%s/%s' % key
+
+
+def entry_hash(entry):
+    return hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()[:16]
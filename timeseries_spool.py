@@ -0,0 +1,120 @@
+import sqlite3
+
+
+# An append-only on-disk log of timeseries values waiting to be sent to the server. Values recorded in memory by the
+# TimeseriesBuffer are written here in batches (one transaction per flush) so that unsent data survives network outages
+# and restarts; values are only removed once the server has acknowledged them, or when the spool exceeds its disk budget,
+# in which case the oldest values are evicted first.
+#
+# We use SQLite in WAL mode with synchronous=NORMAL: a crash can lose at most the last flush, but can't corrupt the spool,
+# and each flush is a single sequential append to the WAL file, which is about as gentle on an SD card as we can get.
+class TimeseriesSpool(object):
+
+    EVICTION_BATCH_SIZE = 1000  # number of values to evict at a time when over budget
+
+    def __init__(self, path, max_bytes):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        if path != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS timeseries_values ('
+                           'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'device_id INTEGER NOT NULL, '
+                           'timeseries_name TEXT NOT NULL, '
+                           'timestamp INTEGER NOT NULL, '
+                           'value TEXT NOT NULL)')
+        self._page_size = self._conn.execute('PRAGMA page_size').fetchone()[0]
+        self.evicted_count = 0  # values dropped because the spool was over budget
+
+    @property
+    def path(self):
+        return self._path
+
+    # write the contents of a drained TimeseriesBuffer to the spool in a single transaction
+    def write(self, series):
+        rows = []
+        for (device_id, timeseries_name), (timestamps, values) in series.items():
+            for ts, value in zip(timestamps, values):
+                rows.append((device_id, timeseries_name, ts, str(value)))
+        if not rows:
+            return 0
+        with self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT INTO timeseries_values (device_id, timeseries_name, timestamp, value) VALUES (?, ?, ?, ?)', rows)
+        self._enforce_budget()
+        return len(rows)
+
+    # return up to limit of the oldest values as (seq, device id, timeseries name, timestamp, value) tuples
+    def read(self, limit, after_seq=0):
+        return self._conn.execute('SELECT seq, device_id, timeseries_name, timestamp, value FROM timeseries_values '
+                                  'WHERE seq > ? ORDER BY seq LIMIT ?', (after_seq, limit)).fetchall()
+
+    # remove values that the server has accepted
+    def ack(self, first_seq, last_seq):
+        self._conn.execute('DELETE FROM timeseries_values WHERE seq BETWEEN ? AND ?', (first_seq, last_seq))
+
+    def pending_count(self):
+        return self._conn.execute('SELECT COUNT(*) FROM timeseries_values').fetchone()[0]
+
+    # bytes used by live data; deleted pages are reused by later writes rather than returned to the file system
+    def size_bytes(self):
+        page_count = self._conn.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = self._conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return (page_count - freelist_count) * self._page_size
+
+    def _enforce_budget(self):
+        evicted = 0
+        while self._max_bytes and self.size_bytes() > self._max_bytes:
+            cursor = self._conn.execute('DELETE FROM timeseries_values WHERE seq IN '
+                                        '(SELECT seq FROM timeseries_values ORDER BY seq LIMIT ?)', (self.EVICTION_BATCH_SIZE,))
+            if cursor.rowcount <= 0:
+                break
+            evicted += cursor.rowcount
+        if evicted:
+            self.evicted_count += evicted
+            print('timeseries spool %s over budget of %d bytes; evicted %d oldest value(s)' % (self._path, self._max_bytes, evicted))
+
+
+# convert rows read from the spool into the same per-series columns used by TimeseriesBuffer
+def spool_rows_to_series(rows):
+    series = {}
+    for _, device_id, timeseries_name, ts, value in rows:
+        columns = series.get((device_id, timeseries_name))
+        if columns is None:
+            columns = series[(device_id, timeseries_name)] = ([], [])
+        columns[0].append(ts)
+        columns[1].append(value)
+    return series
+
+
+# rough size of the JSON the server sees for each series entry and each value within it
+SERIES_ENTRY_OVERHEAD_BYTES = 70
+VALUE_ENTRY_OVERHEAD_BYTES = 50
+
+
+# split rows read from the spool into consecutive chunks that each hold at most max_values values and roughly max_bytes
+# bytes of request JSON; each chunk covers a contiguous range of spool sequence numbers so it can be acknowledged on its own
+def chunk_spool_rows(rows, max_values, max_bytes):
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    chunk_series = set()
+    for row in rows:
+        row_bytes = VALUE_ENTRY_OVERHEAD_BYTES + len(row[4])
+        key = (row[1], row[2])
+        if key not in chunk_series:
+            row_bytes += SERIES_ENTRY_OVERHEAD_BYTES + len(row[2])
+        if chunk and (len(chunk) >= max_values or chunk_bytes + row_bytes > max_bytes):
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+            chunk_series = set()
+            row_bytes = VALUE_ENTRY_OVERHEAD_BYTES + len(row[4]) + SERIES_ENTRY_OVERHEAD_BYTES + len(row[2])
+        chunk.append(row)
+        chunk_bytes += row_bytes
+        chunk_series.add(key)
+    if chunk:
+        chunks.append(chunk)
+    return chunks